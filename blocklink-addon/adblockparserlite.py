@@ -3,7 +3,6 @@
 
 from __future__ import print_function, unicode_literals, absolute_import
 import sys
-import os
 import io
 import re
 import logging as log
@@ -20,7 +19,9 @@ class AdblockRuleLite(adblockparser.AdblockRule):
 
     def _url_matches(self, url):
         if self.regex_re is None:
-            self.regex_re = re.compile(self.regex)
+            # Adblock rules are case-insensitive unless marked match-case
+            flags = 0 if "match-case" in self.options else re.IGNORECASE
+            self.regex_re = re.compile(self.regex, flags)
         return bool(self.regex_re.search(url))
 
 class AdblockRulesLite(adblockparser.AdblockRules):
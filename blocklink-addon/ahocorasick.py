@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+# vim:fileencoding=utf-8:sw=4:et
+#
+# Aho-Corasick multi-pattern string matcher
+#
+# Copyright (C) 2015 Mozbugbox <mozbugbox@yahoo.com.au>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with this library; see the file COPYING.LIB.  If not, write to
+# the Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+#
+"""
+Find all the occurrences of many literal patterns in one pass over a text.
+
+Usage:
+    automaton = Automaton()
+    automaton.add("ads", 1)
+    automaton.add("banner", 2)
+    automaton.build()
+    list(automaton.iter_matches("/ads/banner.gif")) # [1, 2]
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+import sys
+import collections
+
+class Automaton:
+    """Aho-Corasick automaton over a set of literal patterns"""
+    def __init__(self):
+        self._goto = [{}] # state -> {char: next state}
+        self._fail = [0]  # state -> fallback state on mismatch
+        self._out = [[]]  # state -> values of patterns ending here
+        self._built = True
+
+    def __len__(self):
+        return len(self._goto)
+
+    def add(self, pattern, value):
+        """Add a pattern, value is reported when the pattern is found"""
+        goto = self._goto
+        state = 0
+        for c in pattern:
+            nxt = goto[state].get(c)
+            if nxt is None:
+                nxt = len(goto)
+                goto[state][c] = nxt
+                goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            state = nxt
+        self._out[state].append(value)
+        self._built = False
+
+    def build(self):
+        """Compute the failure links. Must be called after adding patterns"""
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+        queue = collections.deque(goto[0].values())
+        for state in queue:
+            fail[state] = 0
+        while queue:
+            state = queue.popleft()
+            for c, nxt in goto[state].items():
+                queue.append(nxt)
+                f = fail[state]
+                while f and c not in goto[f]:
+                    f = fail[f]
+                f = goto[f].get(c, 0)
+                fail[nxt] = f if f != nxt else 0
+                if out[fail[nxt]]:
+                    out[nxt] = out[nxt] + out[fail[nxt]]
+        self._built = True
+
+    def iter_matches(self, text):
+        """Yield the value of each pattern occurrence in text"""
+        if not self._built:
+            self.build()
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+        state = 0
+        for c in text:
+            while state and c not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
+            if out[state]:
+                for value in out[state]:
+                    yield value
+
+def main():
+    automaton = Automaton()
+    for pattern in sys.argv[2:]:
+        automaton.add(pattern, pattern)
+    automaton.build()
+    print(list(automaton.iter_matches(sys.argv[1])))
+
+if __name__ == '__main__':
+    main()
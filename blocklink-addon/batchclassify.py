@@ -0,0 +1,219 @@
+#!/usr/bin/python3
+# vim:fileencoding=utf-8:sw=4:et
+#
+# Classify a batch of urls offline against filter lists
+#
+# Copyright (C) 2015 Mozbugbox <mozbugbox@yahoo.com.au>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with this library; see the file COPYING.LIB.  If not, write to
+# the Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+#
+"""
+Audit filter lists against logged urls without running Liferea.
+
+Urls are read one per line from a file or stdin and classified by the
+same engine the plugin uses, on a pool of processes. The lists are
+parsed once, or taken from their rule snapshots, and handed to every
+worker when it starts. Nothing is downloaded: by default the active
+filters of the plugin config are read from the plugin cache directory.
+
+One `url<TAB>verdict<TAB>rule` line is written per url, in the input
+order, as soon as its batch is done. The verdict is `block` or `allow`,
+the rule the filter line of the blocking rule or `-`.
+
+Usage:
+    python3 batchclassify.py urls.txt > verdicts.tsv
+    zcat urls.gz | python3 batchclassify.py -j 8 -l easylist.txt -
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+import sys
+import os
+import io
+import time
+import multiprocessing
+import logging as log
+try:
+    from configparser import ConfigParser
+except ImportError:
+    from ConfigParser import ConfigParser
+
+import rulecache
+from ruleengine import RuleEngine, rule_source
+
+NATIVE=sys.getfilesystemencoding()
+
+# Where the plugin keeps its filter files and its config
+CACHE_DIR = os.path.expandvars("$HOME/.cache/liferea/blocklink/")
+CONFIG_PATH = os.path.expandvars(
+        "$HOME/.config/liferea/plugins/blocklink/blocklink.ini")
+BATCH_SIZE = 1000 # urls sent to a worker at once
+
+_engine = None # engine of a worker process
+
+def active_filters(config_path=CONFIG_PATH):
+    """Return the file names of the active filters of the plugin config"""
+    config = ConfigParser()
+    config.read(config_path)
+    if not config.has_option("main", "filters"):
+        return []
+    filters = config.get("main", "filters")
+    return [x.strip() for x in filters.split(",") if x.strip()]
+
+def load_lists(paths):
+    """Return the (name, RulePack, index keys, hash) of filter files"""
+    lists = []
+    for path in paths:
+        snapshot = rulecache.load_rules(path)
+        if "report" in snapshot:
+            log.info("Parsed {}: {}".format(os.path.basename(path),
+                snapshot["report"]))
+        lists.append((os.path.basename(path), snapshot["rules"],
+            snapshot["index_keys"], snapshot["stamp"]["hash"]))
+    return lists
+
+def build_engine(lists):
+    engine = RuleEngine()
+    engine.add_lists(lists)
+    return engine
+
+def _init_worker(lists):
+    global _engine
+    _engine = build_engine(lists)
+
+def classify_batch(urls, options=None, engine=None):
+    """Return (url, verdict, rule) of urls"""
+    if engine is None:
+        engine = _engine
+    result = []
+    for url in urls:
+        rule = engine.match(url, options)
+        if rule is None:
+            result.append((url, "allow", "-"))
+        else:
+            result.append((url, "block", rule_source(rule)))
+    return result
+
+def _classify_worker(args):
+    urls, options = args
+    return classify_batch(urls, options)
+
+def read_batches(fd, size=BATCH_SIZE):
+    """Yield lists of the urls of fd, blank and # lines skipped"""
+    batch = []
+    for line in fd:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        batch.append(line)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def classify_stream(fd, lists, options=None, jobs=None,
+        batch_size=BATCH_SIZE):
+    """Yield the (url, verdict, rule) of the urls of fd in input order.
+
+    With jobs of 1 the urls are classified in this process.
+    """
+    if jobs == 1:
+        engine = build_engine(lists)
+        for batch in read_batches(fd, batch_size):
+            for x in classify_batch(batch, options, engine):
+                yield x
+        return
+
+    pool = multiprocessing.Pool(jobs, _init_worker, (lists,))
+    try:
+        args = ((batch, options) for batch in read_batches(fd, batch_size))
+        for result in pool.imap(_classify_worker, args):
+            for x in result:
+                yield x
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def main():
+    def set_stdio_encoding(enc=NATIVE):
+        import codecs; stdio = ["stdin", "stdout", "stderr"]
+        for x in stdio:
+            obj = getattr(sys, x)
+            if not obj.encoding: setattr(sys,  x, codecs.getwriter(enc)(obj))
+    set_stdio_encoding()
+
+    log_level = log.INFO
+    log.basicConfig(format="%(levelname)s>> %(message)s", level=log_level)
+
+    import argparse
+    parser = argparse.ArgumentParser(
+            description="Classify urls with blocklink filter lists")
+    parser.add_argument("-l", "--list", action="append", dest="lists",
+            help="filter list file, may be repeated. The active filters "
+            "of the plugin config by default")
+    parser.add_argument("--cache-dir", default=CACHE_DIR,
+            help="directory of the filter files of the plugin config")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+            help="number of worker processes, all the cpus by default")
+    parser.add_argument("--first-party", action="store_true",
+            help="classify the urls as first party requests")
+    parser.add_argument("-b", "--batch-size", type=int, default=BATCH_SIZE,
+            help="urls per job sent to a worker")
+    parser.add_argument("urls", nargs="?", default="-",
+            help="file of urls, one per line, `-` for stdin")
+    args = parser.parse_args()
+
+    paths = args.lists
+    if not paths:
+        paths = [os.path.join(args.cache_dir, x) for x in active_filters()]
+    missing = [x for x in paths if not os.path.exists(x)]
+    if missing:
+        parser.error("no filter file {}".format(", ".join(missing)))
+    if not paths:
+        parser.error("no active filters in {}, give lists with -l"
+                .format(CONFIG_PATH))
+
+    start = time.time()
+    lists = load_lists(paths)
+    log.info("Loaded {} lists in {:.3f}s".format(len(lists),
+        time.time() - start))
+
+    options = {"third-party": not args.first_party}
+    if args.urls == "-":
+        fd = sys.stdin
+    else:
+        fd = io.open(args.urls, encoding="UTF-8", errors="replace")
+    start = time.time()
+    count = blocked = 0
+    try:
+        for url, verdict, rule in classify_stream(fd, lists, options,
+                args.jobs, args.batch_size):
+            sys.stdout.write("{}\t{}\t{}\n".format(url, verdict, rule))
+            count += 1
+            if verdict == "block":
+                blocked += 1
+    except BrokenPipeError:
+        return # output closed early, e.g. by head
+    finally:
+        if fd is not sys.stdin:
+            fd.close()
+    elapsed = time.time() - start
+    log.info("{} urls, {} blocked in {:.3f}s, {:.0f} urls/s".format(count,
+        blocked, elapsed, count / elapsed if elapsed > 0 else 0.0))
+
+if __name__ == '__main__':
+    main()
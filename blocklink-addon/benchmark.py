@@ -0,0 +1,296 @@
+#!/usr/bin/python3
+# vim:fileencoding=utf-8:sw=4:et
+#
+# Benchmark of filter loading and url lookups
+#
+# Copyright (C) 2015 Mozbugbox <mozbugbox@yahoo.com.au>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with this library; see the file COPYING.LIB.  If not, write to
+# the Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+#
+"""
+Benchmark the filter engine offline, on the filter lists bundled in
+fixtures/ or given ones, and a synthetic url corpus: page resources of
+the visited site, third party CDN assets, tracking pixels and ad scripts
+of hosts taken from the lists.
+
+Measured are the parse and index time of the lists, the memory of the
+loaded engine, and the latency percentiles and throughput of lookups:
+
+    cold:   first lookups, the way the plugin does them, with an empty
+            verdict cache and no regex compiled yet
+    engine: the engine alone once its regexes are compiled
+    warm:   the same lookups again, answered by the verdict cache
+
+The result is printed as JSON, so runs of different versions can be
+compared.
+
+Usage:
+    python3 benchmark.py > before.json
+    python3 benchmark.py -n 50000 --seed 2 easylist.txt easyprivacy.txt
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+import sys
+import os
+import io
+import gc
+import json
+import time
+import random
+import shutil
+import tempfile
+import platform
+import logging as log
+
+from filterparser import FilterParser
+from ruleengine import RuleEngine, HOST_RULE_RE
+from blockcache import BlockCache
+
+NATIVE=sys.getfilesystemencoding()
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        "fixtures")
+FIXTURES = ["ads-filter.txt", "privacy-filter.txt"]
+PERCENTILES = [50, 95, 99]
+# cache key normalization, as the plugin default
+CANONICAL_URLS = False
+STRIP_PARAMS = "utm_*, fbclid, gclid, mc_eid, _"
+
+# Share of each kind of url in the corpus
+CORPUS_KINDS = [
+        ("first-party", 0.40),
+        ("cdn", 0.25),
+        ("pixel", 0.15),
+        ("ad", 0.20),
+        ]
+SITES = ["news{}.com", "blog{}.net", "shop{}.de", "forum{}.org"]
+CDN_HOSTS = ["cdn{}.fastassets.net", "static{}.cloudcdn.com",
+        "img{}.mediahost.io", "fonts{}.webfonts.org"]
+PATH_WORDS = ["index", "main", "app", "vendor", "style", "logo", "header",
+        "article", "story", "photo", "thumb", "bundle", "jquery", "theme"]
+EXTENSIONS = [".js", ".css", ".png", ".jpg", ".gif", ".woff2", ".html"]
+PIXEL_PATHS = ["/pixel.gif", "/p.gif", "/collect", "/b/ss", "/t.png",
+        "/beacon"]
+
+def fixture_paths():
+    """Return the paths of the bundled filter lists"""
+    return [os.path.join(FIXTURE_DIR, x) for x in FIXTURES]
+
+def read_lines(fnames):
+    """Return the lines of filter files by file name"""
+    result = []
+    for fname in fnames:
+        with io.open(fname, encoding="UTF-8") as fd:
+            result.append((fname, fd.read().splitlines()))
+    return result
+
+def rule_hosts(lists):
+    """Return the hostnames of the ||hostname^ rules of the lists"""
+    hosts = set()
+    for fname, lines in lists:
+        for line in lines:
+            m = HOST_RULE_RE.match(line.strip().partition("$")[0])
+            if m:
+                hosts.add(m.group(1))
+    return sorted(hosts)
+
+def make_corpus(count, hosts, seed=0):
+    """Return count (url, options, kind) lookups of page visits.
+
+    The same seed gives the same corpus.
+    """
+    rnd = random.Random(seed)
+    kinds = [k for k, share in CORPUS_KINDS]
+    weights = [share for k, share in CORPUS_KINDS]
+    hosts = hosts or ["ads.example.com"]
+
+    def _path():
+        words = [rnd.choice(PATH_WORDS) for i in range(rnd.randint(1, 3))]
+        if rnd.random() < 0.3:
+            words[-1] += "-{:x}".format(rnd.getrandbits(32))
+        return "/" + "/".join(words) + rnd.choice(EXTENSIONS)
+
+    corpus = []
+    while len(corpus) < count:
+        site = "www." + rnd.choice(SITES).format(rnd.randint(1, 200))
+        # one page visit makes a burst of lookups
+        for i in range(rnd.randint(5, 40)):
+            kind = rnd.choices(kinds, weights)[0]
+            if kind == "first-party":
+                url = "https://{}{}".format(site, _path())
+            elif kind == "cdn":
+                host = rnd.choice(CDN_HOSTS).format(rnd.randint(1, 20))
+                url = "https://{}/{}{}".format(host, rnd.randint(1, 9), _path())
+            elif kind == "pixel":
+                host = rnd.choice(hosts) if rnd.random() < 0.5 else (
+                        "metrics.{}".format(site[4:]))
+                url = "https://{}{}?uid={:x}&cb={}&utm_source=feed".format(
+                        host, rnd.choice(PIXEL_PATHS), rnd.getrandbits(48),
+                        rnd.randint(0, 10**9))
+            else:
+                url = "http://{}{}".format(rnd.choice(hosts), _path())
+            options = {"third-party": kind != "first-party"}
+            corpus.append((url, options, kind))
+    return corpus[:count]
+
+def percentiles(samples, points=PERCENTILES):
+    """Return {"p50": x, ...} of samples by the nearest rank"""
+    ordered = sorted(samples)
+    result = {}
+    for p in points:
+        rank = max(int(round(p / 100.0 * len(ordered))) - 1, 0)
+        result["p{}".format(p)] = ordered[rank] if ordered else 0.0
+    return result
+
+def load_engine(lists):
+    """Parse and index filter lines, return (engine, load stats)"""
+    engine = RuleEngine()
+    stats = {"parse_s": 0.0, "index_s": 0.0, "rules": 0, "lists": {}}
+    for fname, lines in lists:
+        parser = FilterParser()
+        rules, index_keys = parser.parse(lines)
+        start = time.time()
+        engine.add_list(os.path.basename(fname), rules, index_keys, fname)
+        index_time = time.time() - start
+        stats["parse_s"] += parser.parse_time
+        stats["index_s"] += index_time
+        stats["lists"][os.path.basename(fname)] = {
+                "rules": len(rules),
+                "parse_s": parser.parse_time,
+                "index_s": index_time,
+                }
+    stats["rules"] = len(engine)
+    return engine, stats
+
+def measure_memory(lists):
+    """Return the bytes allocated by an engine holding the lists"""
+    import tracemalloc
+    gc.collect()
+    tracemalloc.start()
+    engine, stats = load_engine(lists)
+    gc.collect()
+    traced = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del engine
+    return traced
+
+def cached_lookup(engine, cache):
+    """Return a lookup function doing what the plugin does for a request"""
+    def _lookup(url, options):
+        key = cache.make_key(url, options)
+        try:
+            return cache[key]
+        except KeyError:
+            pass
+        if not engine.may_block(url, options):
+            return False
+        rule, stamp = engine.classify(url, options)
+        cache[key] = (rule is not None, stamp)
+        return rule is not None
+    return _lookup
+
+def time_lookups(lookup, corpus):
+    """Run lookup over the corpus, return latency stats in microseconds"""
+    latencies = []
+    blocked = 0
+    clock = time.perf_counter
+    total_start = clock()
+    for url, options, kind in corpus:
+        start = clock()
+        ret = lookup(url, options)
+        latencies.append((clock() - start) * 1e6)
+        if ret:
+            blocked += 1
+    total = clock() - total_start
+
+    result = dict((k + "_us", v) for k, v in percentiles(latencies).items())
+    result["mean_us"] = sum(latencies) / len(latencies) if latencies else 0.0
+    result["max_us"] = max(latencies) if latencies else 0.0
+    result["lookups_per_s"] = len(corpus) / total if total > 0 else 0.0
+    result["blocked"] = blocked
+    return result
+
+def run(fnames, count, seed=0):
+    """Run the benchmark, return the results as a dict"""
+    lists = read_lines(fnames)
+    corpus = make_corpus(count, rule_hosts(lists), seed)
+    kinds = {}
+    for url, options, kind in corpus:
+        kinds[kind] = kinds.get(kind, 0) + 1
+
+    results = {
+            "python": platform.python_version(),
+            "time": time.time(),
+            "lists": [os.path.basename(x) for x in fnames],
+            "corpus": {"urls": len(corpus), "seed": seed, "kinds": kinds},
+            }
+    engine, results["load"] = load_engine(lists)
+
+    cache_dir = tempfile.mkdtemp(prefix="blocklink-bench-")
+    try:
+        cache = BlockCache(cache_dir, count, count)
+        cache.set_canonical_urls(CANONICAL_URLS, STRIP_PARAMS)
+        cache.set_valid_stamps(engine.stamps())
+        lookup = cached_lookup(engine, cache)
+        results["lookups"] = {
+                "cold": time_lookups(lookup, corpus),
+                "engine": time_lookups(engine.should_block, corpus),
+                "warm": time_lookups(lookup, corpus),
+                }
+        cache.close()
+    finally:
+        shutil.rmtree(cache_dir)
+
+    del engine
+    results["memory"] = {"engine_bytes": measure_memory(lists)}
+    return results
+
+def main():
+    def set_stdio_encoding(enc=NATIVE):
+        import codecs; stdio = ["stdin", "stdout", "stderr"]
+        for x in stdio:
+            obj = getattr(sys, x)
+            if not obj.encoding: setattr(sys,  x, codecs.getwriter(enc)(obj))
+    set_stdio_encoding()
+
+    log_level = log.INFO
+    log.basicConfig(format="%(levelname)s>> %(message)s", level=log_level)
+
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark blocklink")
+    parser.add_argument("-n", "--count", type=int, default=20000,
+            help="number of urls to look up")
+    parser.add_argument("--seed", type=int, default=0,
+            help="seed of the url corpus")
+    parser.add_argument("-o", "--output", help="write the JSON to a file")
+    parser.add_argument("filters", nargs="*",
+            help="filter lists, the bundled fixtures by default")
+    args = parser.parse_args()
+
+    results = run(args.filters or fixture_paths(), args.count, args.seed)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with io.open(args.output, "w", encoding="UTF-8") as fdw:
+            fdw.write(text + "\n")
+    else:
+        print(text)
+    lookups = results["lookups"]
+    log.info("cold p50/p99 {:.1f}/{:.1f}us, warm p50/p99 {:.1f}/{:.1f}us"
+            .format(lookups["cold"]["p50_us"], lookups["cold"]["p99_us"],
+                lookups["warm"]["p50_us"], lookups["warm"]["p99_us"]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+#!/usr/bin/python3
+# vim:fileencoding=utf-8:sw=4:et
+#
+# Cache of block verdicts by url
+#
+# Copyright (C) 2015 Mozbugbox <mozbugbox@yahoo.com.au>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with this library; see the file COPYING.LIB.  If not, write to
+# the Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+#
+"""
+Keep the block verdicts of looked up urls in two LRU caches, one for
+blocked and one for allowed urls, backed by journals on disk. Keys are
+the normalized url with the lookup options packed into an int.
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+import sys
+import os
+
+from lrucache import LRUCache
+from verdictstore import VerdictJournal
+
+NATIVE=sys.getfilesystemencoding()
+
+# Options of should_block packed into cache key bits, 2 bits each for
+# the option being given and its value
+KEY_OPTIONS = ["third-party"]
+
+def options_bits(options):
+    """Pack should_block options into an int"""
+    bits = 0
+    if options:
+        for i, name in enumerate(KEY_OPTIONS):
+            if name in options:
+                bits |= 1 << (2*i)
+                if options[name]:
+                    bits |= 2 << (2*i)
+    return bits
+
+def parse_strip_params(txt):
+    """Split config of query params to strip into (names, prefixes)"""
+    names = set()
+    prefixes = []
+    for x in txt.split(","):
+        x = x.strip()
+        if not x:
+            continue
+        if x.endswith("*"):
+            prefixes.append(x[:-1])
+        else:
+            names.add(x)
+    return frozenset(names), tuple(prefixes)
+
+def canonical_url(url, strip_params=None):
+    """Normalize url for cache keys.
+
+    Lower case the host, drop the fragment and remove the query params
+    matching strip_params, a (names, prefixes) from parse_strip_params().
+    """
+    url = url.partition("#")[0]
+    start = url.find("://")
+    if start < 0:
+        return url
+    start += 3
+    end = len(url)
+    for c in "/?":
+        pos = url.find(c, start, end)
+        if pos >= 0:
+            end = pos
+    url = url[:start] + url[start:end].lower() + url[end:]
+
+    if strip_params and "?" in url:
+        names, prefixes = strip_params
+        base, s, query = url.partition("?")
+        params = [x for x in query.split("&")
+                if x.partition("=")[0] not in names
+                and not (prefixes and x.startswith(prefixes))]
+        url = base + "?" + "&".join(params) if params else base
+    return url
+
+class BlockCache:
+    filename_unblock = "lookup-cache-unblock.journal"
+    filename_block = "lookup-cache-block.journal"
+    # whole cache dumps used before the journals
+    old_filenames = ["lookup-cache-unblock.json", "lookup-cache-block.json"]
+
+    def __init__(self, cache_dir,
+            cache_size_unblock=4096, cache_size_block=8192):
+        """Cache for block test result.
+
+        Two caches for block/unblock are used, so we can set different
+        cache size for blocked or unblocked url cache.
+
+        Every insert is appended to a journal file. The journals are
+        replayed on the first lookup, or by an explicit load().
+
+        Entries are (verdict, stamp) tuples. A lookup only returns the
+        verdict while its stamp is one of the valid stamps of the rule
+        engine, see RuleEngine.classify().
+        """
+        self.cache_dir = cache_dir
+        self.cache_filename_unblock = os.path.join(cache_dir,
+                self.filename_unblock)
+        self.cache_filename_block = os.path.join(cache_dir, self.filename_block)
+        self.loaded = False
+        self.canonical_urls = False
+        self.strip_params = None
+        self.valid_stamps = frozenset()
+        self.evict_stale = False
+        self.hits = {"block": 0, "unblock": 0}
+        self.stale = {"block": 0, "unblock": 0} # hits of outdated verdicts
+        self.misses = 0
+
+        self.cache_unblock = LRUCache(cache_size_unblock)
+        self.cache_block = LRUCache(cache_size_block)
+        self.journal_unblock = VerdictJournal(self.cache_filename_unblock,
+                cache_size_unblock)
+        self.journal_block = VerdictJournal(self.cache_filename_block,
+                cache_size_block)
+
+    def _tiers(self):
+        return [(self.cache_unblock, self.journal_unblock),
+                (self.cache_block, self.journal_block)]
+
+    def load(self):
+        """Replay the journals into the caches"""
+        if self.loaded:
+            return
+        self.loaded = True
+        for cache, journal in self._tiers():
+            for key, value in journal.replay():
+                if not isinstance(key, list) or not isinstance(value, list):
+                    continue # entry of an older format
+                cache[tuple(key)] = tuple(value)
+            cache.reset_insert_count()
+
+        for fname in self.old_filenames:
+            old_path = os.path.join(self.cache_dir, fname)
+            if os.path.exists(old_path):
+                os.remove(old_path)
+
+    def set_valid_stamps(self, stamps, complete=True):
+        """Set the stamps of the verdicts still valid for the rules.
+
+        Entries of other stamps are evicted when looked up, but only if the
+        rule set is complete. Before that they are only treated as missing
+        so a partly loaded rule set does not throw away the warm cache.
+        """
+        self.valid_stamps = frozenset(stamps)
+        self.evict_stale = complete
+
+    def set_canonical_urls(self, enabled, strip_params=""):
+        """Configure the url normalization of cache keys"""
+        self.canonical_urls = enabled
+        self.strip_params = parse_strip_params(strip_params)
+
+    def make_key(self, url, options=None):
+        """Return the cache key of url tested with options"""
+        if self.canonical_urls:
+            url = canonical_url(url, self.strip_params)
+        return (url, options_bits(options))
+
+    def save(self, force=False):
+        """Compact the journals once they grew well past the caches"""
+        for cache, journal in self._tiers():
+            if force or journal.needs_compact():
+                journal.compact(cache.cache.items())
+
+    def close(self):
+        for cache, journal in self._tiers():
+            journal.close()
+
+    def __getitem__(self, key):
+        """Return the cached verdict of key.
+
+        Every tier is looked at, a stale entry in one tier does not hide a
+        valid one in the other.
+        """
+        if not self.loaded:
+            self.load()
+        found = False
+        for tier, cache in [("unblock", self.cache_unblock),
+                ("block", self.cache_block)]:
+            if key not in cache:
+                continue
+            found = True
+            verdict, stamp = cache[key]
+            if stamp in self.valid_stamps:
+                self.hits[tier] += 1
+                return verdict
+            self.stale[tier] += 1
+            if self.evict_stale:
+                del cache[key]
+        if not found:
+            self.misses += 1
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        """Cache a (verdict, stamp) value"""
+        if not self.loaded:
+            self.load()
+        value = tuple(value)
+        if value[0]:
+            self.cache_block[key] = value
+            self.journal_block.append(key, value)
+        else:
+            self.cache_unblock[key] = value
+            self.journal_unblock.append(key, value)
+
+    def counters(self):
+        """Return the hit, miss and size counts of the cache tiers"""
+        result = {"misses": self.misses}
+        for tier, cache in [("block", self.cache_block),
+                ("unblock", self.cache_unblock)]:
+            result[tier] = {
+                    "hits": self.hits[tier],
+                    "stale": self.stale[tier],
+                    "entries": len(cache),
+                    "capacity": cache.capacity,
+                    "evictions": cache.evict_count,
+                    }
+        return result
+
+    def reset_counters(self):
+        self.hits = {"block": 0, "unblock": 0}
+        self.stale = {"block": 0, "unblock": 0}
+        self.misses = 0
+        for cache, journal in self._tiers():
+            cache.reset_evict_count()
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
@@ -34,44 +34,48 @@ Plugin dev help:
 
 import os
 import io
-import sys
 import json
 import time
-import threading
-import parsedate
+import logging as log
 try:
-    from urllib.error import URLError
-    from urllib import request
     from urllib import parse as urlparse
 except ImportError:
-    from urllib2 import URLError
-    import urllib2 as request
     import urlparse
 
+import gi
+
 gi.require_version('Gtk', '3.0')
 gi.require_version('PeasGtk', '1.0')
 gi.require_version('WebKit2', '4.0')
 
-from gi.repository import GObject, Gtk, Gdk, PeasGtk, Liferea
+from gi.repository import GObject, GLib, Gtk, Gdk, PeasGtk, Liferea
 from gi.repository import WebKit2
-
-from adblockparserlite import AdblockRulesLite as AdblockRules
-#from adblockparser import AdblockRules
+# WebKit1, only imported for the load status of a WebKit1 view, see
+# import_webkit1()
+WebKit = None
+
+from filterparser import FilterParser
+from rulestore import RulePack
+from enginesnapshot import EngineSnapshot, ListRules, ListDiff
+from ruleengine import url_host, stamps_of
+from publicsuffix import PublicSuffixList
+from classifypool import ClassifyPool
+from blockcache import BlockCache
+from lookupstats import LookupStats, dump_stats, summary_rows
+from downloader import (Downloader, FETCH_DOWNLOADED, FETCH_NOT_MODIFIED,
+        FETCH_FAILED)
+from taskexecutor import TaskExecutor, TaskError
+import rulecache
+import contentblocker
 
 FILTER_LIST_URL = "https://raw.githubusercontent.com/gorhill/uBlock/master/assets/ublock/filter-lists.json"
 
-TIME_UNIT = {
-        "second": 1,
-        "minute": 60,
-        "hour": 3600,
-        "day": 3600*24,
-        }
-
 CONFIG_TYPES = {
-        bool:  [],
-        int:   ["cache-size-block", "cache-size-unblock"],
+        bool:  ["cache-canonical-urls"],
+        int:   ["cache-size-block", "cache-size-unblock",
+                "classify-deadline-ms", "page-budget-ms"],
         float: [],
-        str:   ["filters"],
+        str:   ["filters", "cache-strip-params"],
         }
 
 
@@ -81,38 +85,47 @@ CONFIG_SECTIONS = [MAIN_SECTION]
 CONFIG_DEFAULTS = {
         "cache-size-block": "8192",
         "cache-size-unblock": "4096",
+        # cache key normalization: lower case host, drop fragment and the
+        # query params listed in cache-strip-params, `*` ends a prefix.
+        # Off by default, rules may match on the stripped params, e.g.
+        # `&utm_source=`, and urls differing in them would share a verdict
+        "cache-canonical-urls": "False",
+        "cache-strip-params": "utm_*, fbclid, gclid, mc_eid, _",
+        # max wait for an uncached url to be classified before allowing it
+        "classify-deadline-ms": "10",
+        # max main thread time spent classifying urls for one page load
+        "page-budget-ms": "100",
         "filters": "",
         }
 
+# Page classify budget: time for this many lookups at the measured lookup
+# latency, at least PAGE_BUDGET_MIN seconds and at most page-budget-ms
+PAGE_LOOKUPS = 100
+PAGE_BUDGET_MIN = 0.005
+
+# Seconds after start() to load the rules if no page painted before
+RULES_LOAD_DELAY = 5
+
 def on_idle(func):
     """Decorator to run func on GObject.idle_add """
     def _idle_run(*args):
         GObject.idle_add(func, *args)
     return _idle_run
 
+def import_webkit1():
+    """Import the WebKit1 module, its views report their load status in
+    WebKit.LoadStatus. It is loaded already when there is such a view."""
+    global WebKit
+    if WebKit is None:
+        gi.require_version('WebKit', '3.0')
+        from gi.repository import WebKit as webkit1
+        WebKit = webkit1
+
 def add_once(func, *args):
     """run the timeout_add/idle_add func once"""
     func(*args)
     return False
 
-def download_file(url, output_name, cb=None, *args):
-    """Download a file and optionally call a callback function with args"""
-    if not url.startswith(("http://", "https://")):
-        url = "https://{}".format(url)
-    try:
-        fd = request.urlopen(url)
-        content = fd.read()
-        fd.close()
-    except  URLError as err:
-        print("Err: {} {}".format(url, err.reason))
-        return
-    content = content.decode("UTF-8").strip()
-    with io.open(output_name, "w", encoding="UTF-8") as fdw:
-        fdw.write(content)
-    if cb is not None:
-        cb(*args)
-    return
-
 def force_alnum(txt):
     """replace non-alphanumeric char with hyphen """
     x = []
@@ -134,9 +147,9 @@ class ConfigManager(ConfigParser):
     config_dir = os.path.expandvars("$HOME/.config/liferea/plugins/blocklink")
 
     def __init__(self, config_dir=None):
-        ConfigParser.__init__(self, CONFIG_DEFAULTS)
         self.changed = False # Flag for self.config changed status
         self.delay_save_timeout = 10
+        ConfigParser.__init__(self, CONFIG_DEFAULTS)
 
         if config_dir is not None:
             self.config_dir = config_dir
@@ -167,71 +180,20 @@ class ConfigManager(ConfigParser):
         GObject.timeout_add_seconds(self.delay_save_timeout, self.save_config)
         return ret
 
-class BlockCache:
-    filename_unblock = "lookup-cache-unblock.json"
-    filename_block = "lookup-cache-block.json"
-    def __init__(self, cache_dir,
-            cache_size_unblock=4096, cache_size_block=8192):
-        """Cache for block test result.
-
-        Two caches for block/unblock are used, so we can set different
-        cache size for blocked or unblocked url cache.
-        """
-        self.save_trigger = 64
-        self.cache_dir = cache_dir
-        self.cache_filename_unblock = os.path.join(cache_dir,
-                self.filename_unblock)
-        self.cache_filename_block = os.path.join(cache_dir, self.filename_block)
-
-        from lrucache import LRUCache
-        self.cache_unblock = LRUCache(cache_size_unblock)
-        self.cache_block = LRUCache(cache_size_block)
-
-    def load(self):
-        self.cache_unblock.load(self.cache_filename_unblock)
-        self.cache_block.load(self.cache_filename_block)
-
-    def make_key(self, url, *args):
-        key = url + json.dumps(args, sort_keys=True, indent=None,
-                separators= (',', ':'))
-        return key
-
-    def save(self, force=False):
-        trigger = 0 if force == True else self.save_trigger
-        if self.cache_unblock.insert_count > trigger:
-            self.cache_unblock.save(self.cache_filename_unblock)
-            self.cache_unblock.reset_insert_count()
-        if self.cache_block.insert_count > trigger:
-            self.cache_block.save(self.cache_filename_block)
-            self.cache_unblock.reset_insert_count()
-
-    def __getitem__(self, key):
-        if key in self.cache_unblock:
-            ret = self.cache_unblock[key]
-        else:
-            ret = self.cache_block[key]
-        return ret
-
-    def __setitem__(self, key, value):
-        if value:
-            self.cache_block[key] = value
-        else:
-            self.cache_unblock[key] = value
-
-    def __contains__(self, key):
-        return key in self.cache_block or key in self.cache_unblock
-
 class FilterManager(GObject.GObject):
     filter_list_fname = "filter-lists.json"
     cache_fname = "lookup-cache.json"
     hidden_css_fname = "element-hide.css"
+    stats_fname = "lookup-stats.json"
+    suffix_cache_fname = "public-suffixes.pickle"
 
     cache_dir = os.path.expandvars("$HOME/.cache/liferea/blocklink/")
     data_dir = os.path.expandvars(
             "$HOME/.local/share/liferea/plugin-data/blocklink")
 
     __gsignals__ = {
-            "filter-list-updated": (GObject.SIGNAL_RUN_FIRST, None, ())
+            "filter-list-updated": (GObject.SIGNAL_RUN_FIRST, None, ()),
+            "content-filter-updated": (GObject.SIGNAL_RUN_FIRST, None, ()),
             }
     def __init__(self):
         GObject.Object.__init__(self)
@@ -239,40 +201,74 @@ class FilterManager(GObject.GObject):
             os.makedirs(self.cache_dir)
 
         self.config = ConfigManager()
-        self.hidden_css_content = None # css to hide element
+        self.hidden_css_content = None # user css to hide element
         self.filter_list = None
         self.filename2filter = None
-        self.thread_download_filter_list = None
+        self.downloader = Downloader()
+        self.tasks = TaskExecutor(GObject.idle_add)
+        # resolved with the filter list once it is read
+        self.filter_list_ready = self.tasks.task("filter list")
+        self.filter_list_download = None # task of the filter list download
+        self.filter_tasks = {} # filter file name -> task loading the filter
+        # filters that failed to load, the rules are complete without them
+        self.failed_filters = set()
         self.refresh_interval = 60*60*24*7 # 1 week
         self.refresh_timeout_id = -1
         self.filters = {}
+        # rules of the active filters, replaced as a whole, never changed
+        self.snapshot = EngineSnapshot()
+        self.list_rules = {} # filter file name -> ListRules to build from
+        # filter file name -> ListDiff of a refresh not built yet
+        self.list_diffs = {}
+        self.engine_build = None # task building the next snapshot
+        self.engine_dirty = False # list_rules changed since the build began
+        self.filter_store = None # compiled WebKit content filters
+        if hasattr(WebKit2, "UserContentFilterStore"):
+            self.filter_store = WebKit2.UserContentFilterStore.new(
+                    os.path.join(self.cache_dir, "content-filters"))
+        self.content_filter = None
+        self.content_filter_id = None
         self.filter_list_update_time = -1
         self.filter_list_fullname = os.path.join(self.cache_dir,
                 self.filter_list_fname)
         self.hidden_css_fname = os.path.join(self.data_dir,
                 self.hidden_css_fname)
-
-        self.load_filter_list()
+        self.stats_fname = os.path.join(self.cache_dir, self.stats_fname)
+        self.suffix_cache_fname = os.path.join(self.cache_dir,
+                self.suffix_cache_fname)
+        self.stats = LookupStats()
+        self.public_suffixes = None # tells first from third party requests
 
         sec = MAIN_SECTION
         cache_size_block = self.config.getint(sec, "cache-size-block")
         cache_size_unblock = self.config.getint(sec, "cache-size-unblock")
         self.cache = BlockCache(self.cache_dir,
                 cache_size_unblock, cache_size_block)
-        def _idle_do():
-            self.cache.load()
-            self.load_hidden_css()
-            self.load_filters()
-
-        GObject.idle_add(_idle_do)
-        #self.load_filters()
+        self.cache.set_canonical_urls(
+                self.config.getboolean(sec, "cache-canonical-urls"),
+                self.config.get(sec, "cache-strip-params"))
+        self.classify_pool = None
+        self.classify_deadline = self.config.getint(sec,
+                "classify-deadline-ms") / 1000.0
+        self.page_budget_max = self.config.getint(sec,
+                "page-budget-ms") / 1000.0
+        self.lookup_latency = 0.001 # moving average of classify time
+        self.rules_timeout_id = -1 # source of the pending rule loading
+        self.rules_started = False
+        # (list hashes, verdict stamps) of the rules of the last run, valid
+        # until they are loaded again, see _load_stored_stamps()
+        self.stored_stamps = None
+
+        # The loading is staged: the cache, the user css and the filter
+        # list on the first idle, the rules only once the first page
+        # painted, so the parse threads do not slow down the first paint
+        GObject.idle_add(add_once, self._load_cache)
 
     @property
     def active_filters(self):
         """Get a list of active filter for current config"""
         sec = MAIN_SECTION
-        filter_str = self.config.get(sec, "filters", "")
-        filter_str = filter_str.decode("UTF-8")
+        filter_str = self.config.get(sec, "filters")
         if len(filter_str) == 0 or filter_str.isspace():
             return []
         filter_list = [x.strip() for x in filter_str.split(",")]
@@ -283,20 +279,92 @@ class FilterManager(GObject.GObject):
         """set active filters for current config"""
         if not isinstance(filters, str):
             filters = ",".join(filters)
-        filters = filters.encode("UTF-8")
         sec = MAIN_SECTION
         self.config.set(sec, "filters", filters)
 
+    def _load_cache(self):
+        """First loading stage: the verdict cache, the user css and the
+        filter list"""
+        self.cache.load()
+        self._load_stored_stamps()
+        self.load_hidden_css()
+        self.load_public_suffixes()
+        self.load_filter_list()
+
+    def _load_stored_stamps(self):
+        """Use the verdicts and the content filter of the rules of the
+        last run before the rules are loaded.
+
+        The stamps are made from the headers of the rule snapshots, which
+        have the hashes of the filter files, so the cached verdicts of the
+        rules are valid and the stored content filter of their generation
+        can be attached while the engine is still empty.
+        """
+        list_hashes = {}
+        exception_lists = []
+        for f in self.active_filters:
+            stamp = rulecache.load_stamp(os.path.join(self.cache_dir, f))
+            if stamp is None:
+                return
+            list_hashes[f] = stamp["hash"]
+            if stamp["exceptions"]:
+                exception_lists.append(f)
+        if not list_hashes:
+            return
+        generation, block_stamps = stamps_of(list_hashes, exception_lists)
+        stamps = frozenset(block_stamps.values()) | {generation}
+        self.stored_stamps = (list_hashes, stamps)
+        self.cache.set_valid_stamps(stamps, False)
+        if self.filter_store is not None and self.content_filter_id is None:
+            identifier = contentblocker.filter_identifier(generation)
+            self.content_filter_id = identifier
+            self._load_content_filter(identifier)
+
+    def _load_rules(self):
+        """Second loading stage: the rules of the active filters"""
+        self.rules_timeout_id = -1
+        self.rules_started = True
+        if self.filter_list is None:
+            self.load_filter_list()
+        self.load_filters()
+        return False
+
+    def page_painted(self):
+        """Load the rules right after the first page painted"""
+        if self.rules_timeout_id > 0:
+            GObject.source_remove(self.rules_timeout_id)
+            self.rules_timeout_id = GObject.idle_add(self._load_rules)
+
+    def load_public_suffixes(self):
+        if self.public_suffixes is None:
+            self.public_suffixes = PublicSuffixList.load(
+                    cache_path=self.suffix_cache_fname)
+
+    def page_domain(self, uri):
+        """Return the registrable domain of a page url"""
+        self.load_public_suffixes()
+        return self.public_suffixes.registrable_domain(url_host(uri))
+
+    def is_third_party(self, page_domain, uri):
+        """Test if a request of uri is third party on a page of the
+        registrable domain page_domain"""
+        self.load_public_suffixes()
+        return self.public_suffixes.is_third_party(page_domain, url_host(uri))
+
     def load_hidden_css(self):
         """load css text for hidding DOM elements"""
         fname = self.hidden_css_fname
         if os.path.exists(fname):
             with io.open(fname, encoding="UTF_8") as fd:
-                content = fd.read()
-                self.hidden_css_content = """
-                <style type="text/css">
-                {}
-                </style>""".format(content)
+                self.hidden_css_content = fd.read()
+
+    def hidden_css(self, host):
+        """Return the css hiding elements on a page of host or None"""
+        parts = [self.hidden_css_content, self.snapshot.cosmetic.css(host)]
+        content = "\n".join(x for x in parts if x)
+        if not content:
+            return None
+        return content
 
     def get_filter_list(self):
         """Get available filters"""
@@ -305,154 +373,475 @@ class FilterManager(GObject.GObject):
 
     def load_filter_list(self, force_download=False):
         """load available filter list either from disk or internet"""
-        filename = self.filter_list_fname
-        full_path = os.path.join(self.cache_dir, filename)
+        full_path = self.filter_list_fullname
         if os.path.exists(full_path) and not force_download:
-            with io.open(full_path, encoding="UTF-8") as fd:
-                filter_list = json.load(fd)
-                filename2filter = {}
-                for k, v in filter_list.items():
-                    filename = force_alnum(v["title"]) + "-filter.txt"
-                    v["filename"] = filename
-                    filename2filter[filename] = k
-                    self.filename2filter = filename2filter
-                self.filter_list = filter_list
-            self.emit("filter-list-updated")
-
-        elif (self.thread_download_filter_list is None or
-            not self.thread_download_filter_list.is_alive() or force_download):
-            def _update_filter_list():
-                """Update filter list in main thread"""
-                GObject.idle_add(self.load_filter_list)
-
-            url = FILTER_LIST_URL
-            t = threading.Thread(target=download_file,
-                    args=(url, full_path, _update_filter_list))
-            self.thread_download_filter_list = t
-            t.start()
-            time.sleep(0.01)
+            self._read_filter_list(full_path)
+
+        elif (self.filter_list_download is None or
+            self.filter_list_download.done() or force_download):
+            download = self.tasks.wrap(
+                    self.downloader.submit(FILTER_LIST_URL, full_path),
+                    "download filter list")
+            self.filter_list_download = self.tasks.after([download],
+                    "update filter list", self._filter_list_fetched,
+                    full_path)
 
         return False
 
+    def _read_filter_list(self, full_path):
+        """Read the filter list file, resolve filter_list_ready"""
+        with io.open(full_path, encoding="UTF-8") as fd:
+            filter_list = json.load(fd)
+        filename2filter = {}
+        for k, v in filter_list.items():
+            filename = force_alnum(v["title"]) + "-filter.txt"
+            v["filename"] = filename
+            filename2filter[filename] = k
+        self.filename2filter = filename2filter
+        self.filter_list = filter_list
+        self.emit("filter-list-updated")
+        if not self.filter_list_ready.done():
+            self.filter_list_ready.set_result(filter_list)
+
+    def _filter_list_fetched(self, full_path, fetch_result):
+        """Update filter list in main thread"""
+        status, content_hash = fetch_result
+        if status == FETCH_NOT_MODIFIED:
+            # restart the refresh interval of the unchanged file
+            os.utime(full_path, None)
+        if status == FETCH_DOWNLOADED or (self.filter_list is None
+                and os.path.exists(full_path)):
+            self._read_filter_list(full_path)
+
     @on_idle
-    def _update_filters(self, k, v):
-        """Update filters in main thread"""
+    def _update_filters(self, k, v, pack, index_keys, cosmetic, diff=None):
+        """Update filters in main thread
+
+        diff is the ListDiff of a refresh from the loaded rules.
+        """
         if k in self.filters:
             self.filters[k] = v
+            self.list_rules[k] = ListRules(pack, index_keys, v["__hash"],
+                    cosmetic)
+            if diff is not None:
+                self.list_diffs[k] = diff
+            else:
+                self.list_diffs.pop(k, None)
+            self._rebuild_engine()
 
-    def _load_filters(self, filter_list):
-        """Load filter rules to filter manager"""
-        need_download = []
-        for f in filter_list:
-            full_path = os.path.join(self.cache_dir, f)
-            if not os.path.exists(full_path):
-                need_download.append((f, full_path))
-                continue
-            self._load_filter(f, full_path)
-            time.sleep(0.01)
+    def _rebuild_engine(self):
+        """Build a snapshot of list_rules in a thread and publish it.
 
-        if len(need_download) > 0:
-            # wait for self.filename2filter
-            while self.filename2filter is None:
-                time.sleep(5)
+        The snapshot is built from the current one, see EngineSnapshot.
+        Changes made while a build runs are collected in one more build
+        once it is done.
+        """
+        self.engine_dirty = True
+        if self.engine_build is not None and not self.engine_build.done():
+            return
+        self.engine_dirty = False
+        diffs, self.list_diffs = self.list_diffs, {}
+        build = self.tasks.run_in_thread("build filter engine",
+                EngineSnapshot, dict(self.list_rules), self.snapshot, diffs)
+        self.engine_build = self.tasks.after([build], "publish filter engine",
+                self._publish_engine)
+        self.engine_build.add_done_callback(self._engine_built)
+
+    def _publish_engine(self, snapshot):
+        """Swap in a new snapshot in main thread"""
+        old_engine = self.snapshot.engine
+        snapshot.engine.lookups += old_engine.lookups
+        snapshot.engine.rules_tested += old_engine.rules_tested
+        self.snapshot = snapshot
+        log.info("Built filter engine in {:.3f}s: {} rules".format(
+            snapshot.build_time, len(snapshot)))
+        self._update_cache_stamps()
+
+    def _engine_built(self, task):
+        if task.cancelled():
+            self.engine_dirty = True # built again by start()
+        elif task.exception() is not None:
+            log.warning("Failed to build filter engine: {}".format(
+                task.exception()))
+        elif self.engine_dirty:
+            self._rebuild_engine()
+
+    def _update_cache_stamps(self):
+        """Tell the cache which verdicts the current rules still back.
+
+        The rules are complete once every filter is loaded, except those
+        that failed to, so a dead filter url does not hold back the
+        content filter.
+        """
+        snapshot = self.snapshot
+        complete = self._rules_complete()
+        stamps = snapshot.stamps
+        if complete:
+            self.stored_stamps = None
+        elif self.stored_stamps is not None:
+            # the lists loaded so far are those of the last run
+            list_hashes = self.stored_stamps[0]
+            if all(list_hashes.get(x) == rules.list_hash
+                    for x, rules in self.list_rules.items()):
+                stamps = stamps | self.stored_stamps[1]
+            else:
+                self.stored_stamps = None
+        self.cache.set_valid_stamps(stamps, complete)
+        if complete:
+            self.update_content_filter()
+
+    def _rules_complete(self):
+        """Test if the snapshot has the rules of every loaded filter"""
+        return set(self.snapshot.lists) == set(self.filters).difference(
+                self.failed_filters)
+
+    def update_content_filter(self):
+        """Compile the loaded rules into a WebKit content filter.
+
+        The compiled filter is stored by the generation of the rules, so
+        it is only made again when a list changed.
+        """
+        if self.filter_store is None:
+            return
+        snapshot = self.snapshot
+        if len(snapshot) == 0:
+            identifier = None
+        else:
+            identifier = contentblocker.filter_identifier(
+                    snapshot.generation)
+        if identifier == self.content_filter_id:
+            return
+        self.content_filter_id = identifier
+        if identifier is None:
+            self._set_content_filter(None, None)
+            return
+        self._load_content_filter(identifier, sorted(snapshot.lists))
+
+    def _load_content_filter(self, identifier, filters=None):
+        """Attach the stored content filter of identifier.
 
-        for f, full_path in need_download:
+        If it is not stored, it is made from the filter files filters, or
+        left for update_content_filter() without them.
+        """
+        def _loaded(store, result):
             try:
-                url = self.filename2filter[f]
-                download_file(url, full_path, self._load_filter, f, full_path)
-            except  URLError as err:
-                print("Err: {} {}".format(url, err.reason))
+                content_filter = store.load_finish(result)
+            except GLib.Error:
+                if filters is None:
+                    if identifier == self.content_filter_id:
+                        # made once the rules are loaded, maybe already
+                        self.content_filter_id = None
+                        if self._rules_complete():
+                            self.update_content_filter()
+                    return
+                translate = self.tasks.run_in_thread(
+                        "translate content filter",
+                        self._translate_content_filter, filters)
+                self.tasks.after([translate], "compile content filter",
+                        self._save_content_filter, identifier)
+                return
+            self._set_content_filter(identifier, content_filter)
+        self.filter_store.load(identifier, None, _loaded)
+
+    def _translate_content_filter(self, filters):
+        """Translate the lines of filter files to content blocker JSON,
+        runs in a thread"""
+        start = time.time()
+        sources = contentblocker.read_sources(
+                [os.path.join(self.cache_dir, x) for x in filters])
+        rules, counts = contentblocker.translate(sources)
+        log.info("Translated content filter in {:.3f}s: {} rules, {} left to "
+                "the python matcher".format(time.time() - start,
+                    counts["translated"], counts["unsupported"]))
+        return contentblocker.to_json(rules)
+
+    def _save_content_filter(self, identifier, json_text):
+        """Compile content blocker JSON in the filter store in main thread"""
+        if identifier != self.content_filter_id:
+            return
+        def _saved(store, result):
+            try:
+                content_filter = store.save_finish(result)
+            except GLib.Error as e:
+                log.warning("Failed to compile content filter: {}".format(e))
+                return
+            self._set_content_filter(identifier, content_filter)
+            store.fetch_identifiers(None, _remove_stale)
+
+        def _remove_stale(store, result):
+            for x in store.fetch_identifiers_finish(result):
+                if (x.startswith(contentblocker.IDENTIFIER_PREFIX)
+                        and x != self.content_filter_id):
+                    store.remove(x, None, None)
+
+        data = GLib.Bytes.new(json_text.encode("UTF-8"))
+        self.filter_store.save(identifier, data, None, _saved)
+
+    def _set_content_filter(self, identifier, content_filter):
+        if identifier != self.content_filter_id:
+            return # the rules changed meanwhile
+        self.content_filter = content_filter
+        self.emit("content-filter-updated")
 
     def load_filters(self):
-        """load filter into rules by using threading"""
-        filter_list = self.active_filters
-        for f in filter_list:
+        """Load the active filters, each is used as soon as it is ready"""
+        for f in self.active_filters:
+            if self.filters.get(f) is None:
+                self._start_filter_task(f)
+
+    def _start_filter_task(self, f, url=None, force_download=False):
+        """Chain the download and the parse of a filter in tasks.
+
+        A filter missing on disk is downloaded, from url or else from the
+        url in the filter list once that is ready.
+        """
+        task = self.filter_tasks.get(f)
+        if task is not None and not task.done():
+            if not force_download:
+                return task
+            task.cancel()
+        self.failed_filters.discard(f)
+        if f not in self.filters:
             self.filters[f] = None
-        t = threading.Thread(target=self._load_filters,
-                args=(filter_list,))
-        t.start()
-        time.sleep(0.01)
-
-    def _load_filter(self, f, full_path):
-        """Use lower case key"""
-        rinfo = {}
+            if (self.stored_stamps is not None
+                    and f not in self.stored_stamps[0]):
+                self.stored_stamps = None
+            self._update_cache_stamps()
+
+        full_path = os.path.join(self.cache_dir, f)
+        if os.path.exists(full_path) and not force_download:
+            task = self.tasks.run_in_thread("load " + f, self._load_filter,
+                    f, full_path)
+        else:
+            if url is None:
+                download = self.tasks.after([self.filter_list_ready],
+                        "download " + f, self._download_filter, f, full_path)
+            else:
+                download = self._download_filter(f, full_path, url=url)
+            task = self.tasks.after([download], "load " + f,
+                    self._filter_fetched, f, full_path)
+        self.filter_tasks[f] = task
+        task.add_done_callback(lambda x: self._filter_task_done(f, x))
+        return task
+
+    def _download_filter(self, f, full_path, filter_list=None, url=None):
+        """Return the task of a filter download"""
+        if url is None:
+            url = self.filename2filter.get(f)
+            if url is None:
+                raise TaskError("{} is not in the filter list".format(f))
+        return self.tasks.wrap(self.downloader.submit(url, full_path),
+                "download " + f)
+
+    def _filter_fetched(self, f, full_path, fetch_result):
+        """Parse a fetched filter in a thread"""
+        status, content_hash = fetch_result
+        return self.tasks.run_in_thread("parse " + f,
+                self._on_filter_fetched, status, content_hash, f, full_path)
+
+    def _filter_task_done(self, f, task):
+        if task.cancelled() or task.exception() is None:
+            return
+        log.warning("Failed to {}: {}".format(task.name, task.exception()))
+        if (self.filter_tasks.get(f) is task and f in self.filters
+                and self.filters[f] is None):
+            # not loaded, do not wait for it to call the rules complete
+            self.failed_filters.add(f)
+            self._update_cache_stamps()
+
+    def _diff_filter(self, full_path, old_sources):
+        """Diff a filter file against the rule_source() of the rules loaded
+        from it before.
+
+        Return (RulePack of added rules, their index keys, rule_source() of
+        removed rules, header info, all the element hiding entries). Only
+        the new lines are parsed.
+        """
+        sources = set()
+        def _lines(fd):
+            for line in fd:
+                sources.add(line.strip())
+                yield line
+
+        parser = FilterParser(default_expires=self.refresh_interval)
         with io.open(full_path, encoding="UTF-8") as fd:
-            rules = AdblockRules(fd, supported_options=["third-party"],
-                    skip_unsupported_rules=False)
-            rinfo["__rules"] = rules
-            fd.seek(0, os.SEEK_SET)
-            for i in range(20):
-                line = fd.readline().strip()
-                if line and not line.startswith(("!", "[Adblock")):
-                    break
-                line = line.lstrip("!").lstrip()
-                k, s, v = line.partition(":")
-                if not s: continue
-                klow = k.lower()
-                if klow == "last modified":
-                    lmdate = parsedate.parse_date(v)
-                    if lmdate:
-                        v = lmdate
-                    else:
-                        v = time.time()
-                elif klow == "expires":
-                    parts = v.strip().split()
-                    exdate = float(parts[0])
-                    exunit = parts[1].lower().rstrip("s")
-                    v = exdate * TIME_UNIT[exunit]
-                rinfo[klow] = v
-
-        if "last modified" not in rinfo:
-            rinfo["last modified"] = time.time()
-        if "expires" not in rinfo:
-            rinfo["expires"] = self.refresh_interval
+            added, added_keys = parser.parse(_lines(fd), old_sources)
+        removed = old_sources - sources
+        log.info("Parsed {} changes: {}, removed {}".format(
+            os.path.basename(full_path), parser.report(), len(removed)))
+        return (RulePack.from_rules(added), added_keys, removed, parser.info,
+                parser.cosmetic)
+
+    def _load_filter(self, f, full_path, content_hash=None):
+        """Load filter rules from the rule snapshot or the filter file.
 
+        content_hash is the sha1 of the file if the caller already knows it.
+        """
+        snapshot = rulecache.load_rules(full_path, content_hash,
+                self.refresh_interval)
+        if "report" in snapshot:
+            log.info("Parsed {}: {}".format(os.path.basename(full_path),
+                snapshot["report"]))
+        pack = snapshot["rules"]
+        index_keys = snapshot["index_keys"]
+        cosmetic = snapshot["cosmetic"]
+        content_hash = snapshot["stamp"]["hash"]
+
+        rinfo = dict(snapshot["info"])
+        rinfo["__hash"] = content_hash
         # 2 extra hours
         rinfo["update_time"] = rinfo["last modified"] + rinfo["expires"] + 7200
 
-        self._update_filters(f, rinfo)
-        return rules
+        self._update_filters(f, rinfo, pack, index_keys, cosmetic)
+        return pack
+
+    def _refresh_filter(self, f, full_path, content_hash=None):
+        """Apply the changes of a downloaded filter to the loaded rules"""
+        old_info = self.filters.get(f)
+        if not old_info:
+            return self._load_filter(f, full_path, content_hash)
+        if content_hash is None:
+            content_hash = rulecache.file_hash(full_path)
+        if content_hash == old_info["__hash"]:
+            return None
+        old_rules = self.list_rules.get(f)
+        if old_rules is None:
+            return self._load_filter(f, full_path, content_hash)
+
+        old_pack, old_keys = old_rules.pack, old_rules.index_keys
+        added, added_keys, removed, rinfo, cosmetic = self._diff_filter(
+                full_path, set(old_pack.sources()))
+        kept = [i for i, x in enumerate(old_pack.sources())
+                if x not in removed]
+        pack = RulePack.concat([(old_pack, kept),
+            (added, range(len(added)))])
+        index_keys = [old_keys[i] for i in kept] + added_keys
+        rulecache.save_snapshot(full_path, pack, index_keys, rinfo,
+                content_hash, cosmetic)
+
+        rinfo = dict(rinfo)
+        rinfo["__hash"] = content_hash
+        rinfo["update_time"] = rinfo["last modified"] + rinfo["expires"] + 7200
+        diff = ListDiff(old_rules.list_hash, added, added_keys, removed)
+        self._update_filters(f, rinfo, pack, index_keys, cosmetic, diff)
+        return added
+
+    def _on_filter_fetched(self, status, content_hash, f, full_path):
+        """Load a fetched filter, runs in the downloader thread.
+
+        A filter the server reports unchanged is not parsed again unless
+        it is not loaded yet. A changed filter that is loaded is updated
+        with the diff to the loaded version. A failed download of a filter
+        that is not loaded falls back to the file of an older download, or
+        fails the task.
+        """
+        if status == FETCH_DOWNLOADED:
+            self._refresh_filter(f, full_path, content_hash)
+        elif status == FETCH_NOT_MODIFIED:
+            if self.filters.get(f) is None:
+                self._load_filter(f, full_path)
+            else:
+                self._filter_not_modified(f)
+        elif status == FETCH_FAILED and self.filters.get(f) is None:
+            if not os.path.exists(full_path):
+                raise TaskError("download of {} failed".format(f))
+            self._load_filter(f, full_path)
+
+    @on_idle
+    def _filter_not_modified(self, f):
+        """Push back the update time of an unchanged filter in main thread"""
+        rinfo = self.filters.get(f)
+        if rinfo:
+            rinfo["update_time"] = time.time() + rinfo["expires"]
 
     def load_filter(self, url, force_download=False):
-        """Load filter rules by thread"""
+        """Load filter rules in tasks"""
         f = self.filter_list[url]["filename"]
-        full_path = os.path.join(self.cache_dir, f)
-        def _load_again():
-            self._load_filter(f, full_path)
-
-        #self.filters[f] = None
-        if os.path.exists(full_path) and force_download == False:
-            t = threading.Thread(target=self._load_filter,
-                    args=(f, full_path))
-        else:
-            t = threading.Thread(target=download_file,
-                    args=(url, full_path, self._load_filter, f, full_path))
-        t.start()
-        time.sleep(0.01)
+        self._start_filter_task(f, url, force_download)
 
     def unload_filter(self, url):
         """remove rules of an active filter"""
         f = self.filter_list[url]["filename"]
-        del self.filters[f]
-
-    def _should_block(self, url, *args):
-        """Worker for test if a url should be blocked"""
+        task = self.filter_tasks.pop(f, None)
+        if task is not None:
+            task.cancel()
+        # not there before the rules are loaded, e.g. only configured
+        self.filters.pop(f, None)
+        self.stored_stamps = None
+        self.failed_filters.discard(f)
+        self.list_rules.pop(f, None)
+        self.list_diffs.pop(f, None)
+        self._update_cache_stamps()
+        self._rebuild_engine()
+
+    def _classify(self, url, options=None):
+        """Worker for test if a url should be blocked, return (ret, stamp)
+
+        Runs on the classify pool threads, so it must not touch the cache.
+        """
         max_url_length = 2048 # max length of url before treat as garbage
-        ret = False
+        engine = self.snapshot.engine # the same rules for the whole lookup
+        if len(url) > max_url_length:
+            return (False, engine.generation)
+        if not engine.may_block(url, options):
+            # no rule can block it, cached like any other verdict
+            self.stats.count("no-trigger")
+            return (False, engine.generation)
+
+        start = time.time()
+        rule, stamp = engine.classify(url, options)
+        elapsed = time.time() - start
+        self.lookup_latency = 0.9 * self.lookup_latency + 0.1 * elapsed
+        self.stats.add_lookup(elapsed)
+        return (rule is not None, stamp)
+
+    def _store_verdict(self, key, result):
+        """Cache a (ret, stamp) classify result in main thread"""
+        self.cache[key] = result
+        self.cache.save()
 
-        if len(url) > max_url_length: return ret
+    def _should_block(self, url, *args):
+        """Test if a url should be blocked and cache the result"""
+        result = self._classify(url, *args)
+        self._store_verdict(self.cache.make_key(url, *args), result)
+        return result[0]
 
-        for rinfo in self.filters.values():
-            if rinfo is None: continue
-            rules = rinfo["__rules"]
-            ret = rules.should_block(url, *args)
-            if ret:
-                break
+    def classify_url(self, key, url, options, deadline=None):
+        """Test an uncached url on the classify pool.
 
-        key = self.cache.make_key(url, *args)
-        self.cache[key] = ret
-        self.cache.save()
-        return ret
+        Wait for the result until the deadline, the classify deadline by
+        default. If the deadline passes or too many urls are queued the
+        url is allowed. The result is cached once ready either way.
+        """
+        if self.classify_pool is None:
+            return self._should_block(url, options)
+        future = self.classify_pool.submit(key, url, options,
+                self._store_verdict)
+        if future is None:
+            self.stats.count("queue-full")
+            return False
+        if deadline is None:
+            deadline = self.classify_deadline
+        result = self.classify_pool.wait(future, deadline)
+        if result is None:
+            self.stats.count("deadline-missed")
+            return False
+        return result[0]
+
+    def classify_later(self, key, url, options):
+        """Queue an uncached url for classification without waiting"""
+        if self.classify_pool is not None:
+            self.stats.count("deferred")
+            self.classify_pool.submit(key, url, options, self._store_verdict)
+
+    def page_budget(self):
+        """Return main thread classify time in seconds for a page load.
+
+        Scaled by the measured lookup latency so slow machines get a
+        larger share, capped by page-budget-ms.
+        """
+        budget = self.lookup_latency * PAGE_LOOKUPS
+        return min(max(budget, PAGE_BUDGET_MIN), self.page_budget_max)
 
     def should_block(self, url, *args):
         """Test if a  url should be blocked with cache"""
@@ -464,8 +853,38 @@ class FilterManager(GObject.GObject):
             #print("NO cached0")
             ret = self._should_block(url, *args)
             #print("NO cached1")
+        self.stats.count("blocked" if ret else "allowed")
         return ret
 
+    def stats_dict(self):
+        """Return the lookup counters with the cache and engine counters"""
+        result = self.stats.as_dict()
+        result["cache"] = self.cache.counters()
+        engine = self.snapshot.engine
+        lookups = engine.lookups
+        result["engine"] = {
+                "rules": len(engine),
+                "lookups": lookups,
+                "rules_tested": engine.rules_tested,
+                "rules_per_lookup": (float(engine.rules_tested) / lookups
+                    if lookups else 0.0),
+                }
+        return result
+
+    def dump_stats(self, path=None):
+        """Write the statistics as JSON, return the file name"""
+        if path is None:
+            path = self.stats_fname
+        dump_stats(path, self.stats_dict())
+        return path
+
+    def reset_stats(self):
+        self.stats.reset()
+        self.cache.reset_counters()
+        engine = self.snapshot.engine
+        engine.lookups = 0
+        engine.rules_tested = 0
+
     def refresh_filters(self):
         """Update expired filter files"""
         now = time.time()
@@ -503,12 +922,35 @@ class FilterManager(GObject.GObject):
         if self.refresh_timeout_id < 0:
             self.refresh_timeout_id = GObject.timeout_add_seconds(
                     refresh_check_timeout, self.refresh_filters)
+        if self.classify_pool is None:
+            self.classify_pool = ClassifyPool(self._classify, GObject.idle_add)
+        if self.filter_list_ready.cancelled():
+            # started again after stop(), resume the loading it cancelled
+            self.filter_list_ready = self.tasks.task("filter list")
+            if self.filter_list is not None:
+                self.filter_list_ready.set_result(self.filter_list)
+        if self.rules_started:
+            self._load_rules()
+        elif self.rules_timeout_id < 0:
+            self.rules_timeout_id = GObject.timeout_add_seconds(
+                    RULES_LOAD_DELAY, self._load_rules)
+        if self.engine_dirty:
+            self._rebuild_engine()
 
     def stop(self):
+        self.tasks.shutdown()
+        if self.rules_timeout_id > 0:
+            GObject.source_remove(self.rules_timeout_id)
+            self.rules_timeout_id = -1
         if self.refresh_timeout_id > 0:
             GObject.source_remove(self.refresh_timeout_id)
             self.refresh_timeout_id = -1
+        if self.classify_pool is not None:
+            self.classify_pool.shutdown()
+            self.classify_pool = None
+        self.downloader.pool.close()
         self.cache.save(force=True)
+        self.cache.close()
         self.config.save_config()
 
 class BlockLinkAddonPlugin (GObject.Object,
@@ -518,7 +960,6 @@ class BlockLinkAddonPlugin (GObject.Object,
     shell = GObject.property (type=Liferea.Shell)
 
     _shell = None
-    filter_manager = FilterManager()
 
     def __init__(self):
         GObject.Object.__init__(self)
@@ -579,6 +1020,11 @@ class BlockLinkAddonPlugin (GObject.Object,
         for v in current_views:
             self.hook_webkit_view(v)
 
+        fm = self.filter_manager
+        cid = fm.connect("content-filter-updated",
+                self.on_content_filter_updated)
+        fm.blocklink_content_filter_cid = cid
+
         # watch new webkit view in browser_tabs
         bt_notebook = self.browser_notebook
         cid = bt_notebook.connect("page-added", self.on_tab_added)
@@ -595,6 +1041,10 @@ class BlockLinkAddonPlugin (GObject.Object,
         bt_notebook.disconnect(bt_notebook.blocklink_page_added_cid)
         del bt_notebook.blocklink_page_added_cid
 
+        fm = self.filter_manager
+        fm.disconnect(fm.blocklink_content_filter_cid)
+        del fm.blocklink_content_filter_cid
+
         self.filter_manager.stop()
 
     def on_tab_added(self, noteb, child, page_num, *user_data_dummy):
@@ -605,33 +1055,77 @@ class BlockLinkAddonPlugin (GObject.Object,
 
     def hook_webkit_view(self, wk_view):
         """on new webkit_view, deal with it"""
-        wk_view.cache_miss = 0
-        cid = wk_view.connect("resource-request-starting",
-                self.on_resource_request_starting)
-        wk_view.blocklink_resource_request_start_cid = cid
+        self.attach_content_filter(wk_view)
+        wk_view.blocklink_budget = self.filter_manager.page_budget()
+        if isinstance(wk_view, WebKit2.WebView):
+            # no per request signal, only the content filter blocks
+            hooks = [("load-changed", self.on_load_changed,
+                "blocklink_load_changed_cid")]
+        else:
+            import_webkit1()
+            hooks = [
+                    ("resource-request-starting",
+                        self.on_resource_request_starting,
+                        "blocklink_resource_request_start_cid"),
+                    ("notify::load-status", self.on_load_status_changed,
+                        "blocklink_load_status_cid"),
+                    ]
+        for signal, handler, attr in hooks:
+            try:
+                cid = wk_view.connect(signal, handler)
+            except TypeError:
+                # one missing signal does not keep the other hooks out
+                print("Blocklink: no {} signal on {}".format(signal,
+                    type(wk_view).__name__))
+                continue
+            setattr(wk_view, attr, cid)
 
-        cid = wk_view.connect("notify::load-status",
-                self.on_load_status_changed)
-        wk_view.blocklink_load_status_cid = cid
+    def attach_content_filter(self, wk_view):
+        """Replace the content filter of the view by the current one"""
+        if not hasattr(wk_view, "get_user_content_manager"):
+            return
+        manager = wk_view.get_user_content_manager()
+        old_filter = getattr(wk_view, "blocklink_content_filter", None)
+        if old_filter is not None:
+            manager.remove_filter(old_filter)
+        content_filter = self.filter_manager.content_filter
+        if content_filter is not None:
+            manager.add_filter(content_filter)
+        wk_view.blocklink_content_filter = content_filter
+
+    def on_content_filter_updated(self, filter_manager):
+        """Give the new content filter to all the views"""
+        for v in self.current_webviews:
+            self.attach_content_filter(v)
 
     def unhook_webkit_view(self, wk_view):
         """ clean hooks on webkit_view"""
         cids = [
                 "blocklink_resource_request_start_cid",
                 "blocklink_load_status_cid",
+                "blocklink_load_changed_cid",
                ]
         for cid in cids:
             if hasattr(wk_view, cid):
                 wk_view.disconnect(getattr(wk_view, cid))
 
-        for k in cids + ["cache_miss"]:
+        old_filter = getattr(wk_view, "blocklink_content_filter", None)
+        if old_filter is not None:
+            wk_view.get_user_content_manager().remove_filter(old_filter)
+        self.detach_style_sheet(wk_view)
+
+        for k in cids + ["blocklink_budget", "blocklink_page_domain",
+                "blocklink_content_filter"]:
             if hasattr(wk_view, k):
                 delattr(wk_view, k)
 
     def on_resource_request_starting(self, web_view, web_frame,
             web_resource, request, response, *user_data_dummy):
-        """webkit_view resouce-request-starting event handler"""
-        max_cache_miss = -1 # per page max cache missing/new url
+        """webkit_view resouce-request-starting event handler
+
+        Only the cache is looked at here, an uncached url is classified on
+        the classify pool, waited for within the page budget.
+        """
         #print(request, dir(request))
         ret = False
         uri = request.props.uri
@@ -639,14 +1133,17 @@ class BlockLinkAddonPlugin (GObject.Object,
         #request.props.uri = "about:blank"
         filter_schemes = ("http:", "https:")
         if not uri.startswith(filter_schemes): return ret
-        third_party = (
-                web_view.props.load_status != WebKit.LoadStatus.PROVISIONAL)
-        if third_party:
-            urlobj = urlparse.urlparse(web_view.props.uri)
-            domain = urlobj.hostname
+        fm = self.filter_manager
+        if web_view.props.load_status == WebKit.LoadStatus.PROVISIONAL:
+            # new page load
+            web_view.blocklink_budget = fm.page_budget()
+            third_party = False
         else:
-            web_view.cache_miss = 0
-            domain = ""
+            page_domain = getattr(web_view, "blocklink_page_domain", None)
+            if page_domain is None:
+                page_domain = fm.page_domain(web_view.props.uri or "")
+                web_view.blocklink_page_domain = page_domain
+            third_party = fm.is_third_party(page_domain, uri)
 
         options = {"third-party": third_party}
         key = self.filter_manager.cache.make_key(uri, options)
@@ -654,13 +1151,19 @@ class BlockLinkAddonPlugin (GObject.Object,
             ret = self.filter_manager.cache[key]
             #print("cached")
         except KeyError:
-            if 0 < max_cache_miss < web_view.cache_miss:
+            budget = web_view.blocklink_budget
+            if budget <= 0:
+                # out of budget for this page, allow now and have the
+                # result cached for the next visit
+                fm.classify_later(key, uri, options)
                 ret = False
             else:
-                ret = self.filter_manager._should_block(uri,options)
-                web_view.cache_miss += 1
-                #print(web_view.cache_miss)
+                start = time.time()
+                ret = fm.classify_url(key, uri, options,
+                        min(budget, fm.classify_deadline))
+                web_view.blocklink_budget -= time.time() - start
 
+        self.filter_manager.stats.count("blocked" if ret else "allowed")
         if ret:
             #print("blocked: {}".format(uri))
             request.props.uri = "about:blank"
@@ -669,12 +1172,57 @@ class BlockLinkAddonPlugin (GObject.Object,
     def on_load_status_changed(self, wk_view, gparamstring):
         """handle load status change for WebView"""
         status = wk_view.props.load_status
-        if status == WebKit.LoadStatus.FIRST_VISUALLY_NON_EMPTY_LAYOUT:
+        if status == WebKit.LoadStatus.COMMITTED:
+            # parsed once per page, the requests of the page test against it
+            wk_view.blocklink_page_domain = self.filter_manager.page_domain(
+                    wk_view.props.uri or "")
+        elif status == WebKit.LoadStatus.FIRST_VISUALLY_NON_EMPTY_LAYOUT:
             dom = wk_view.get_dom_document()
             head = dom.props.head
-            css_content = self.filter_manager.hidden_css_content
+            host = urlparse.urlparse(wk_view.props.uri or "").hostname
+            css_content = self.filter_manager.hidden_css(host or "")
             if css_content:
-                head.insert_adjacent_html("beforeend", css_content)
+                head.insert_adjacent_html("beforeend", """
+                        <style type="text/css">
+                        {}
+                        </style>""".format(css_content))
+            self.filter_manager.page_painted()
+
+    def on_load_changed(self, wk_view, load_event):
+        """handle load-changed of a WebKit2 WebView"""
+        if load_event == WebKit2.LoadEvent.COMMITTED:
+            self.attach_style_sheet(wk_view)
+        elif load_event == WebKit2.LoadEvent.FINISHED:
+            self.filter_manager.page_painted()
+
+    def attach_style_sheet(self, wk_view):
+        """Give a WebKit2 view the element hiding css of its page host"""
+        self.detach_style_sheet(wk_view)
+        host = urlparse.urlparse(wk_view.get_uri() or "").hostname or ""
+        css_content = self.filter_manager.hidden_css(host)
+        if not css_content:
+            return
+        # only applied to pages of the host, should the content manager
+        # be shared with other views
+        allow_list = ["*://{}/*".format(host)] if host else None
+        style_sheet = WebKit2.UserStyleSheet.new(css_content,
+                WebKit2.UserContentInjectedFrames.ALL_FRAMES,
+                WebKit2.UserStyleLevel.USER, allow_list, None)
+        wk_view.get_user_content_manager().add_style_sheet(style_sheet)
+        wk_view.blocklink_style_sheet = style_sheet
+
+    def detach_style_sheet(self, wk_view):
+        """Remove the element hiding css of a WebKit2 view"""
+        style_sheet = getattr(wk_view, "blocklink_style_sheet", None)
+        if style_sheet is None:
+            return
+        manager = wk_view.get_user_content_manager()
+        if hasattr(manager, "remove_style_sheet"):
+            manager.remove_style_sheet(style_sheet)
+        else:
+            # WebKit before 2.32 can only drop all the style sheets
+            manager.remove_all_style_sheets()
+        del wk_view.blocklink_style_sheet
 
     def do_create_configure_widget(self):
         if not hasattr(self, "filter_manager"):
@@ -736,6 +1284,59 @@ class BlockLinkAddonPlugin (GObject.Object,
         swin.set_size_request(int(w*3/5), int(h*3/5))
         swin.add(tree)
         grid.attach(swin, 0, 0, 1, 1)
+        grid.attach(self.setup_stats_ui(GMARGIN), 1, 0, 1, 1)
+
+    def setup_stats_ui(self, margin):
+        """Build the lookup statistics panel"""
+        box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=margin)
+        box.props.margin = margin
+
+        stats_tree = Gtk.TreeView(model=Gtk.ListStore(str, str))
+        self.stats_tree = stats_tree
+        renderer_text = Gtk.CellRendererText(xalign=0.0)
+        renderer_value = Gtk.CellRendererText(xalign=1.0)
+        stats_tree.append_column(Gtk.TreeViewColumn("Statistics",
+            renderer_text, text=0))
+        stats_tree.append_column(Gtk.TreeViewColumn("",
+            renderer_value, text=1))
+        swin = Gtk.ScrolledWindow()
+        swin.props.vexpand = True
+        swin.add(stats_tree)
+        box.pack_start(swin, True, True, 0)
+
+        buttons = Gtk.Box(spacing=margin)
+        for label, handler in [("Refresh", self.fill_stats),
+                ("Reset", self.on_stats_reset),
+                ("Save JSON", self.on_stats_save)]:
+            button = Gtk.Button(label=label)
+            button.connect("clicked", handler)
+            buttons.pack_start(button, False, False, 0)
+        box.pack_start(buttons, False, False, 0)
+        self.stats_status = Gtk.Label(xalign=0.0)
+        self.stats_status.props.selectable = True
+        box.pack_start(self.stats_status, False, False, 0)
+
+        self.fill_stats()
+        # refresh while the dialog is open
+        timeout_id = GObject.timeout_add_seconds(2, self.fill_stats)
+        box.connect("destroy", lambda *args: GObject.source_remove(timeout_id))
+        return box
+
+    def fill_stats(self, *args):
+        """Fill the statistics treeview"""
+        model = self.stats_tree.get_model()
+        model.clear()
+        for row in summary_rows(self.filter_manager.stats_dict()):
+            model.append(row)
+        return True
+
+    def on_stats_reset(self, button):
+        self.filter_manager.reset_stats()
+        self.fill_stats()
+
+    def on_stats_save(self, button):
+        path = self.filter_manager.dump_stats()
+        self.stats_status.set_text("Saved to {}".format(path))
 
     def fill_tree(self, *args):
         """Fill filter list treeview"""
@@ -791,4 +1392,3 @@ def treeview_equal_func(model, col, akey, aiter, *data):
     if akey.lower() in val.lower():
         ret = False
     return ret
-
@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+# vim:fileencoding=utf-8:sw=4:et
+#
+# Classify URLs on worker threads
+#
+# Copyright (C) 2015 Mozbugbox <mozbugbox@yahoo.com.au>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with this library; see the file COPYING.LIB.  If not, write to
+# the Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+#
+"""
+Run URL classification on a small thread pool with a bounded number of
+pending jobs. The caller waits for a result until a deadline and gets
+the result delivered to the main loop whenever it is ready, so a late
+result can still be cached for the next request of the same URL.
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+import sys
+import threading
+import logging as log
+from concurrent import futures
+
+NATIVE=sys.getfilesystemencoding()
+
+class ClassifyPool:
+    """Bounded pool of classification jobs"""
+    def __init__(self, classify, deliver, workers=2, max_pending=64):
+        """
+        classify(url, options) runs on a worker thread. Its result is
+        passed as on_done(key, result) through deliver(func, *args), which
+        is expected to call func on the main loop, e.g. GObject.idle_add.
+        """
+        self.classify = classify
+        self.deliver = deliver
+        self.max_pending = max_pending
+        self._executor = futures.ThreadPoolExecutor(max_workers=workers)
+        self._pending = {} # key -> future
+        self._lock = threading.Lock()
+
+    def submit(self, key, url, options, on_done):
+        """Queue url for classification and return its future.
+
+        A job already pending for key is reused. None is returned when
+        too many jobs are pending.
+        """
+        with self._lock:
+            future = self._pending.get(key)
+            if future is not None:
+                return future
+            if len(self._pending) >= self.max_pending:
+                return None
+            future = self._executor.submit(self.classify, url, options)
+            self._pending[key] = future
+
+        def _done(fut):
+            with self._lock:
+                self._pending.pop(key, None)
+            if fut.cancelled():
+                return
+            try:
+                result = fut.result()
+            except Exception as e:
+                log.warning("classify failed {}: {}".format(url, e))
+                return
+            self.deliver(on_done, key, result)
+        future.add_done_callback(_done)
+        return future
+
+    def wait(self, future, timeout):
+        """Return the result of future, or None after timeout seconds"""
+        try:
+            return future.result(timeout)
+        except futures.TimeoutError:
+            return None
+
+    def pending_count(self):
+        return len(self._pending)
+
+    def shutdown(self):
+        """Drop the pending jobs and stop the workers"""
+        with self._lock:
+            pending = list(self._pending.values())
+            self._pending.clear()
+        for future in pending:
+            future.cancel()
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,340 @@
+#!/usr/bin/python3
+# vim:fileencoding=utf-8:sw=4:et
+#
+# Translate adblock rules into WebKit content blocker rules
+#
+# Copyright (C) 2015 Mozbugbox <mozbugbox@yahoo.com.au>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with this library; see the file COPYING.LIB.  If not, write to
+# the Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+#
+"""
+Translate adblock network rules into the JSON content blocker rules that
+WebKit compiles with a UserContentFilterStore and enforces in its network
+process, without a call into Python per request.
+
+The url-filter of a content blocker rule is a limited regex: no `|`
+alternatives, no counted repetition and ASCII only. A rule whose pattern
+ends with the `^` separator becomes two url-filters, one for a separator
+char and one for the end of the URL. Regex rules are kept when they only
+need \\d, \\w or a short counted repetition on top of that. Rules that
+can not be expressed, like regexes with alternatives, rules with both
+included and excluded domains or with options WebKit does not know, are
+left to the Python matcher.
+
+Exception rules become `ignore-previous-rules` actions and are put after
+all the blocking rules, so they apply to every list.
+
+The rules are read from the lines of the filter files, not from the
+parsed rules of the engine: the parser drops the rules with options the
+Python matcher lacks, like $script or $domain=, which WebKit can take.
+
+Usage:
+    rules, counts = translate(read_sources(paths))
+    json_text = to_json(rules)
+
+Run as a command to translate filter files to JSON on stdout.
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+import sys
+import io
+import re
+import json
+import logging as log
+
+from adblockparserlite import AdblockRuleLite
+from filterparser import is_comment, is_cosmetic
+
+NATIVE=sys.getfilesystemencoding()
+
+# Bump when the translation changes, compiled filters are stored by it
+TRANSLATOR_VERSION = 3
+IDENTIFIER_PREFIX = "blocklink-"
+
+# `||` matches the start of the hostname or of one of its subdomains
+HOST_ANCHOR = r"^[^:]+://+([^/]+\.)?"
+# `^` matches anything but a letter, a digit or one of _-.%
+SEPARATOR = r"[^a-zA-Z0-9_.%-]"
+REGEX_SPECIALS = frozenset(".+?()[]{}\\$|^*")
+# Regex escapes a url-filter lacks, by the char class they stand for
+CLASS_ESCAPES = {"d": "[0-9]", "w": "[a-zA-Z0-9_]"}
+# Longest counted repetition spelled out in a url-filter
+MAX_REPEAT = 16
+
+# Adblock request types by WebKit resource-type. `object` plugins have
+# no type of their own, they are loaded as media.
+RESOURCE_TYPES = {
+        "script": "script",
+        "image": "image",
+        "background": "image",
+        "stylesheet": "style-sheet",
+        "object": "media",
+        "object-subrequest": "media",
+        "media": "media",
+        "subdocument": "document",
+        "xmlhttprequest": "raw",
+        "websocket": "raw",
+        "ping": "raw",
+        "other": "raw",
+        }
+ALL_RESOURCE_TYPES = frozenset(["document", "image", "style-sheet",
+    "script", "font", "raw", "svg-document", "media", "popup"])
+
+def filter_identifier(generation):
+    """Return the filter store identifier of the rules of a generation"""
+    return "{}{}-{}".format(IDENTIFIER_PREFIX, TRANSLATOR_VERSION,
+            generation)
+
+def regex_filter(regex):
+    """Return the url-filter of a rule regex, or None if WebKit can not
+    take it.
+
+    \\d and \\w become char classes and counted repetition of a single
+    char or class is spelled out.
+    """
+    atoms = []
+    i = 0
+    while i < len(regex):
+        c = regex[i]
+        if c == "\\":
+            escaped = regex[i+1:i+2]
+            if not escaped or escaped.isalnum() and escaped not in "dw":
+                return None
+            atoms.append(CLASS_ESCAPES.get(escaped, "\\" + escaped))
+            i += 2
+        elif c == "[":
+            end = i + 1
+            while end < len(regex) and regex[end] != "]":
+                end += 2 if regex[end] == "\\" else 1
+            if end >= len(regex):
+                return None
+            inner = regex[i+1:end]
+            for name, chars in CLASS_ESCAPES.items():
+                inner = inner.replace("\\" + name, chars[1:-1])
+            if re.search(r"\\[0-9a-zA-Z]", inner):
+                return None
+            atoms.append("[" + inner + "]")
+            i = end + 1
+        elif c == "(":
+            if regex.startswith("(?:", i):
+                i += 2
+            elif regex.startswith("(?", i):
+                return None # look around
+            atoms.append("(")
+            i += 1
+        elif c == "{":
+            end = regex.find("}", i)
+            if end < 0 or not atoms or atoms[-1] in ("(", ")"):
+                return None
+            low, comma, high = regex[i+1:end].partition(",")
+            try:
+                low = int(low)
+                high = int(high) if high else (low if not comma else None)
+            except ValueError:
+                return None
+            if low > MAX_REPEAT or (high is not None and high > MAX_REPEAT):
+                return None
+            atom = atoms.pop()
+            atoms.extend([atom] * low)
+            if high is None:
+                atoms.append(atom + "*")
+            else:
+                atoms.extend([atom + "?"] * (high - low))
+            i = end + 1
+        elif (c == "?" and regex[i-1:i] in ("*", "+", "?", "}")
+                and regex[i-2:i-1] != "\\"):
+            i += 1 # lazy makes no difference to a search
+        elif c == "|":
+            return None
+        else:
+            atoms.append(c)
+            i += 1
+    return "".join(atoms)
+
+def pattern_filters(pattern):
+    """Return the url-filters of an adblock url pattern, or None"""
+    try:
+        pattern.encode("ascii")
+    except UnicodeError:
+        return None
+    if len(pattern) > 1 and pattern.startswith("/") and pattern.endswith("/"):
+        url_filter = regex_filter(pattern[1:-1])
+        return None if url_filter is None else [url_filter]
+
+    if pattern.startswith("||"):
+        start = HOST_ANCHOR
+        pattern = pattern[2:]
+    elif pattern.startswith("|"):
+        start = "^"
+        pattern = pattern[1:]
+    else:
+        start = ""
+    end = ""
+    if pattern.endswith("|"):
+        end = "$"
+        pattern = pattern[:-1]
+    if not start:
+        pattern = pattern.lstrip("*")
+    if not end:
+        pattern = pattern.rstrip("*")
+    if not start and not pattern:
+        return [".*"]
+
+    trailing_separator = not end and pattern.endswith("^")
+    if trailing_separator:
+        pattern = pattern[:-1]
+    parts = []
+    for c in pattern:
+        if c == "*":
+            parts.append(".*")
+        elif c == "^":
+            parts.append(SEPARATOR)
+        elif c in REGEX_SPECIALS:
+            parts.append("\\" + c)
+        else:
+            parts.append(c)
+    body = start + "".join(parts)
+    if trailing_separator:
+        return [body + SEPARATOR, body + "$"]
+    return [body + end]
+
+def ascii_domain(domain):
+    """Return the IDNA form of a domain= value, or None if it has none.
+
+    Content blockers only take ASCII domains.
+    """
+    try:
+        return domain.lower().encode("idna").decode("ascii")
+    except UnicodeError:
+        return None
+
+def rule_trigger(rule):
+    """Return the trigger of a parsed rule without url-filter, or None"""
+    trigger = {}
+    included = set()
+    excluded = set()
+    for name, value in rule.options.items():
+        if name == "third-party":
+            trigger["load-type"] = ["third-party" if value else "first-party"]
+        elif name == "match-case":
+            trigger["url-filter-is-case-sensitive"] = value
+        elif name == "domain":
+            includes = [d for d, v in value.items() if v]
+            excludes = [d for d, v in value.items() if not v]
+            if includes and excludes:
+                return None
+            domains = includes or excludes
+            if any("*" in d for d in domains):
+                return None
+            domains = [ascii_domain(d) for d in domains]
+            if None in domains:
+                return None
+            domains = ["*" + d for d in sorted(domains)]
+            trigger["if-domain" if includes else "unless-domain"] = domains
+        elif name in RESOURCE_TYPES:
+            (included if value else excluded).add(RESOURCE_TYPES[name])
+        else:
+            return None
+
+    if included or excluded:
+        types = (included or ALL_RESOURCE_TYPES) - excluded
+        if not types:
+            return None
+        trigger["resource-type"] = sorted(types)
+    return trigger
+
+def translate_rule(source):
+    """Return the content blocker rules of an adblock rule, or None"""
+    rule = AdblockRuleLite(source)
+    if rule.is_comment or rule.is_html_rule:
+        return None
+    filters = pattern_filters(rule.rule_text)
+    if filters is None:
+        return None
+    trigger = rule_trigger(rule)
+    if trigger is None:
+        return None
+    if rule.is_exception:
+        action = {"type": "ignore-previous-rules"}
+    else:
+        action = {"type": "block"}
+
+    result = []
+    for url_filter in filters:
+        filter_trigger = dict(trigger)
+        filter_trigger["url-filter"] = url_filter
+        result.append({"trigger": filter_trigger, "action": action})
+    return result
+
+def translate(sources):
+    """Return (content blocker rules, counts) of adblock rule sources.
+
+    counts has the number of "translated" and "unsupported" rules.
+    """
+    blocks = []
+    exceptions = []
+    counts = {"translated": 0, "unsupported": 0}
+    for source in sources:
+        result = translate_rule(source)
+        if result is None:
+            counts["unsupported"] += 1
+            continue
+        counts["translated"] += 1
+        if source.startswith("@@"):
+            exceptions.extend(result)
+        else:
+            blocks.extend(result)
+    return blocks + exceptions, counts
+
+def read_sources(paths):
+    """Return the network rule lines of filter files, each line once"""
+    sources = []
+    seen = set()
+    for path in paths:
+        with io.open(path, encoding="UTF-8") as fd:
+            for line in fd:
+                line = line.strip()
+                if (not line or is_comment(line) or is_cosmetic(line)
+                        or line in seen):
+                    continue
+                seen.add(line)
+                sources.append(line)
+    return sources
+
+def to_json(rules):
+    """Return the JSON text of content blocker rules for the filter store"""
+    return json.dumps(rules, separators=(",", ":"), sort_keys=True)
+
+def main():
+    def set_stdio_encoding(enc=NATIVE):
+        import codecs; stdio = ["stdin", "stdout", "stderr"]
+        for x in stdio:
+            obj = getattr(sys, x)
+            if not obj.encoding: setattr(sys,  x, codecs.getwriter(enc)(obj))
+    set_stdio_encoding()
+
+    log_level = log.INFO
+    log.basicConfig(format="%(levelname)s>> %(message)s", level=log_level)
+
+    sources = read_sources(sys.argv[1:])
+    rules, counts = translate(sources)
+    log.info("{} rules: {} translated, {} unsupported, {} content rules"
+            .format(len(sources), counts["translated"],
+                counts["unsupported"], len(rules)))
+    print(to_json(rules))
+
+if __name__ == '__main__':
+    main()
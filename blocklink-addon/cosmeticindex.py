@@ -0,0 +1,182 @@
+#!/usr/bin/python3
+# vim:fileencoding=utf-8:sw=4:et
+#
+# Element hiding selectors indexed by hostname
+#
+# Copyright (C) 2015 Mozbugbox <mozbugbox@yahoo.com.au>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with this library; see the file COPYING.LIB.  If not, write to
+# the Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+#
+"""
+Index the `##selector` and `domain##selector` rules of the filter lists,
+so a page only gets the selectors that apply to its host: the generic
+ones, minus those excepted for the host, plus the ones of the host and
+its parent domains.
+
+Usage:
+    index = CosmeticIndex()
+    index.add_list("easylist", parser.cosmetic)
+    index.css("www.example.com") # ".ad, #banner { display: none ... }"
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+import sys
+import io
+import logging as log
+
+from lrucache import LRUCache
+from ruleengine import host_suffixes
+
+NATIVE=sys.getfilesystemencoding()
+
+# Selectors per CSS rule. A selector the engine can not parse voids the
+# whole rule, so they are not all put in one.
+SELECTORS_PER_RULE = 32
+HIDE_DECLARATION = " { display: none !important; }"
+
+def selectors_css(selectors):
+    """Return the style sheet hiding the elements of selectors"""
+    selectors = sorted(selectors)
+    rules = []
+    for i in range(0, len(selectors), SELECTORS_PER_RULE):
+        rules.append(", ".join(selectors[i:i+SELECTORS_PER_RULE]) +
+                HIDE_DECLARATION)
+    return "\n".join(rules)
+
+class CosmeticIndex:
+    """Element hiding rules of several filter lists by hostname"""
+    def __init__(self, cache_size=256):
+        self.lists = {}       # list name -> [(domains, selector, exception)]
+        self.generic = frozenset()
+        self.generic_exceptions = frozenset()
+        self.hosts = {}       # hostname -> set of selectors
+        self.exceptions = {}  # hostname -> set of selectors not to apply
+        self.generic_css = ""
+        self._css = LRUCache(cache_size) # hostname -> css
+
+    def add_list(self, name, entries):
+        """Set the element hiding entries of a filter list.
+
+        entries are (domains, selector, is_exception) as made by
+        filterparser.parse_cosmetic().
+        """
+        self.add_lists([(name, entries)])
+
+    def add_lists(self, lists):
+        """Set the entries of several (name, entries) lists at once"""
+        for name, entries in lists:
+            self.lists[name] = list(entries)
+        self._rebuild()
+
+    def remove_list(self, name):
+        if self.lists.pop(name, None) is not None:
+            self._rebuild()
+
+    def _rebuild(self):
+        generic = set()
+        generic_exceptions = set()
+        hosts = {}
+        exceptions = {}
+        for entries in self.lists.values():
+            for domains, selector, is_exception in entries:
+                includes = [d for d, include in domains if include]
+                excludes = [d for d, include in domains if not include]
+                if is_exception:
+                    if not includes:
+                        generic_exceptions.add(selector)
+                    for d in includes:
+                        exceptions.setdefault(d, set()).add(selector)
+                    continue
+                if includes:
+                    for d in includes:
+                        hosts.setdefault(d, set()).add(selector)
+                else:
+                    generic.add(selector)
+                for d in excludes:
+                    exceptions.setdefault(d, set()).add(selector)
+
+        self.generic = frozenset(generic - generic_exceptions)
+        self.generic_exceptions = frozenset(generic_exceptions)
+        self.hosts = hosts
+        self.exceptions = exceptions
+        self.generic_css = selectors_css(self.generic)
+        self._css = LRUCache(self._css.capacity)
+
+    def selectors(self, host):
+        """Return the set of selectors to hide on a page of host"""
+        specific, excepted = self._host_selectors(host)
+        return (self.generic - excepted) | specific
+
+    def _host_selectors(self, host):
+        """Return (selectors of host, selectors excepted for host)"""
+        specific = set()
+        excepted = set(self.generic_exceptions)
+        for suffix in host_suffixes(host.lower()):
+            if suffix in self.hosts:
+                specific.update(self.hosts[suffix])
+            if suffix in self.exceptions:
+                excepted.update(self.exceptions[suffix])
+        specific -= excepted
+        return specific, excepted
+
+    def css(self, host):
+        """Return the style sheet hiding the elements for a page of host"""
+        host = host or ""
+        try:
+            return self._css[host]
+        except KeyError:
+            pass
+        specific, excepted = self._host_selectors(host)
+        if excepted.isdisjoint(self.generic):
+            # the generic style sheet is shared by most of the pages
+            parts = [self.generic_css, selectors_css(specific)]
+        else:
+            parts = [selectors_css((self.generic - excepted) | specific)]
+        css = "\n".join(x for x in parts if x)
+        self._css[host] = css
+        return css
+
+    def __len__(self):
+        return sum(len(x) for x in self.lists.values())
+
+def main():
+    def set_stdio_encoding(enc=NATIVE):
+        import codecs; stdio = ["stdin", "stdout", "stderr"]
+        for x in stdio:
+            obj = getattr(sys, x)
+            if not obj.encoding: setattr(sys,  x, codecs.getwriter(enc)(obj))
+    set_stdio_encoding()
+
+    log_level = log.INFO
+    log.basicConfig(format="%(levelname)s>> %(message)s", level=log_level)
+
+    from filterparser import FilterParser
+    index = CosmeticIndex()
+    for fname in sys.argv[1:-1]:
+        parser = FilterParser()
+        with io.open(fname, encoding="UTF-8") as fd:
+            parser.parse(fd)
+        index.add_list(fname, parser.cosmetic)
+    log.info("{} generic, {} hostnames".format(len(index.generic),
+        len(index.hosts)))
+
+    host = sys.argv[-1]
+    selectors = index.selectors(host)
+    print("{}: {} selectors".format(host, len(selectors)))
+    print(index.css(host))
+
+if __name__ == '__main__':
+    main()
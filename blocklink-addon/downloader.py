@@ -0,0 +1,281 @@
+#!/usr/bin/python3
+# vim:fileencoding=utf-8:sw=4:et
+#
+# Concurrent filter list downloader
+#
+# Copyright (C) 2015 Mozbugbox <mozbugbox@yahoo.com.au>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with this library; see the file COPYING.LIB.  If not, write to
+# the Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+#
+"""
+Download filter lists on a few worker threads.
+
+Connections are kept alive and reused per host. The ETag and
+Last-Modified of a download are saved next to the file and sent back
+with the next request, so an unchanged list costs a 304 and no write.
+
+The body is streamed to a temporary file next to the target and renamed
+over it once complete, so memory use is bounded by the chunk size and a
+failed download never leaves a truncated file behind.
+
+Usage:
+    downloader = Downloader()
+    future = downloader.submit("http://localhost:8000/list.txt",
+            "/tmp/list.txt", callback, "list.txt")
+    # callback(status, content_hash, "list.txt") runs on the worker thread
+    status, content_hash = future.result()
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+import sys
+import os
+import io
+import json
+import codecs
+import hashlib
+import tempfile
+import threading
+import logging as log
+from concurrent import futures
+
+try:
+    from http import client as httpclient
+    from urllib import parse as urlparse
+except ImportError:
+    import httplib as httpclient
+    import urlparse
+
+NATIVE=sys.getfilesystemencoding()
+
+FETCH_DOWNLOADED = "downloaded"
+FETCH_NOT_MODIFIED = "not-modified"
+FETCH_FAILED = "failed"
+
+META_SUFFIX = ".http.json"
+CHUNK_SIZE = 65536
+MAX_REDIRECTS = 5
+USER_AGENT = "liferea-blocklink/0.1"
+
+class DownloadError(Exception):
+    pass
+
+class ConnectionPool:
+    """Idle keep-alive HTTP connections by (scheme, host, port)"""
+    def __init__(self, timeout=30):
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, scheme, host, port):
+        """Return an idle connection to the host or a new one"""
+        key = (scheme, host, port)
+        with self._lock:
+            conns = self._idle.get(key)
+            if conns:
+                return conns.pop()
+        if scheme == "https":
+            return httpclient.HTTPSConnection(host, port,
+                    timeout=self.timeout)
+        return httpclient.HTTPConnection(host, port, timeout=self.timeout)
+
+    def put(self, scheme, host, port, conn):
+        """Give back a connection whose response was fully read"""
+        with self._lock:
+            self._idle.setdefault((scheme, host, port), []).append(conn)
+
+    def close(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+def load_meta(output_name):
+    """Return the saved HTTP validators of a downloaded file"""
+    path = output_name + META_SUFFIX
+    if not os.path.exists(path) or not os.path.exists(output_name):
+        return {}
+    try:
+        with io.open(path, encoding="UTF-8") as fd:
+            return json.load(fd)
+    except ValueError:
+        return {}
+
+def save_meta(output_name, meta):
+    path = output_name + META_SUFFIX
+    with io.open(path, "w", encoding="UTF-8") as fdw:
+        fdw.write(json.dumps(meta))
+
+class Downloader:
+    """Download files concurrently with conditional GET"""
+    def __init__(self, workers=4, timeout=30):
+        self.pool = ConnectionPool(timeout)
+        self._executor = futures.ThreadPoolExecutor(max_workers=workers)
+
+    def submit(self, url, output_name, callback=None, *args):
+        """Queue a download, callback(status, content_hash, *args) runs on
+        the worker. The content hash is None unless the file was downloaded.
+
+        The result of the returned future is (status, content_hash).
+        """
+        def _run():
+            try:
+                status, content_hash = self.fetch(url, output_name)
+            except Exception as e:
+                log.warning("Err: {} {}".format(url, e))
+                status, content_hash = FETCH_FAILED, None
+            if callback is not None:
+                callback(status, content_hash, *args)
+            return status, content_hash
+        return self._executor.submit(_run)
+
+    def _request(self, url, headers):
+        """Send a GET and return (connection key, connection, response)"""
+        parts = urlparse.urlsplit(url)
+        scheme = parts.scheme
+        host = parts.hostname
+        port = parts.port or (443 if scheme == "https" else 80)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        conn = self.pool.get(scheme, host, port)
+        try:
+            conn.request("GET", path, headers=headers)
+            resp = conn.getresponse()
+        except (httpclient.HTTPException, IOError, OSError):
+            # a reused keep-alive connection may have been closed by the
+            # server, retry once on a fresh one
+            conn.close()
+            conn = self.pool.get(scheme, host, port)
+            conn.request("GET", path, headers=headers)
+            resp = conn.getresponse()
+        return (scheme, host, port), conn, resp
+
+    def _release(self, key, conn, resp):
+        """Keep the connection for reuse unless the server closes it"""
+        if resp.will_close:
+            conn.close()
+        else:
+            self.pool.put(key[0], key[1], key[2], conn)
+
+    def _write_body(self, resp, output_name):
+        """Stream the response body to output_name, return its sha1 hex.
+
+        The body must be UTF-8 text. It is written to a temporary file in
+        the same directory and only renamed to output_name when complete.
+        """
+        sha = hashlib.sha1()
+        decoder = codecs.getincrementaldecoder("UTF-8")()
+        fd, tmp_path = tempfile.mkstemp(prefix=".download-",
+                dir=os.path.dirname(os.path.abspath(output_name)))
+        try:
+            with io.open(fd, "wb") as fdw:
+                for chunk in iter(lambda: resp.read(CHUNK_SIZE), b""):
+                    decoder.decode(chunk) # raise on bad encoding
+                    sha.update(chunk)
+                    fdw.write(chunk)
+                decoder.decode(b"", True)
+                if resp.length:
+                    # chunked reads return b"" on a short body
+                    raise DownloadError("incomplete body, {} bytes missing"
+                            .format(resp.length))
+            os.rename(tmp_path, output_name)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return sha.hexdigest()
+
+    def fetch(self, url, output_name):
+        """Download url to output_name, return (status, content hash)"""
+        if not url.startswith(("http://", "https://")):
+            url = "https://{}".format(url)
+        request_url = url
+
+        meta = load_meta(output_name)
+        headers = {"User-Agent": USER_AGENT}
+        if meta.get("url") == request_url:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last-modified"):
+                headers["If-Modified-Since"] = meta["last-modified"]
+
+        for i in range(MAX_REDIRECTS + 1):
+            key, conn, resp = self._request(url, headers)
+            if resp.status in (301, 302, 303, 307, 308):
+                location = resp.getheader("Location")
+                resp.read()
+                self._release(key, conn, resp)
+                if not location:
+                    # the body is read, the released connection stays usable
+                    raise DownloadError("HTTP {} {} without a Location"
+                            .format(resp.status, resp.reason))
+                url = urlparse.urljoin(url, location)
+                continue
+            break
+        else:
+            raise DownloadError("too many redirects")
+
+        try:
+            if resp.status == 304:
+                resp.read()
+                return FETCH_NOT_MODIFIED, None
+            if resp.status != 200:
+                resp.read()
+                raise DownloadError("HTTP {} {}".format(resp.status,
+                    resp.reason))
+            content_hash = self._write_body(resp, output_name)
+        except BaseException:
+            # the connection is unusable with a partly read body
+            conn.close()
+            raise
+        self._release(key, conn, resp)
+
+        new_meta = {
+                "url": request_url,
+                "etag": resp.getheader("ETag"),
+                "last-modified": resp.getheader("Last-Modified"),
+                }
+        save_meta(output_name, new_meta)
+        return FETCH_DOWNLOADED, content_hash
+
+    def shutdown(self):
+        """Drop queued downloads and close idle connections"""
+        self._executor.shutdown(wait=False)
+        self.pool.close()
+
+def main():
+    def set_stdio_encoding(enc=NATIVE):
+        import codecs; stdio = ["stdin", "stdout", "stderr"]
+        for x in stdio:
+            obj = getattr(sys, x)
+            if not obj.encoding: setattr(sys,  x, codecs.getwriter(enc)(obj))
+    set_stdio_encoding()
+
+    log_level = log.INFO
+    log.basicConfig(format="%(levelname)s>> %(message)s", level=log_level)
+
+    downloader = Downloader()
+    args = sys.argv[1:]
+    jobs = [downloader.submit(url, output_name)
+            for url, output_name in zip(args[::2], args[1::2])]
+    for url, job in zip(args[::2], jobs):
+        print(url, job.result()[0])
+    downloader.shutdown()
+
+if __name__ == '__main__':
+    main()
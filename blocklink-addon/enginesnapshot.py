@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+# vim:fileencoding=utf-8:sw=4:et
+#
+# Immutable snapshot of the rules of the active filter lists
+#
+# Copyright (C) 2015 Mozbugbox <mozbugbox@yahoo.com.au>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with this library; see the file COPYING.LIB.  If not, write to
+# the Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+#
+"""
+An EngineSnapshot holds everything a lookup needs: the merged rule
+engine, the element hiding index and the verdict stamps of the rules.
+It is built in one go from the rules of each list, on a worker thread,
+and not changed afterwards.
+
+A change of the lists builds a new snapshot, which is then published by
+assigning one reference. A lookup reads that reference once and sees
+either the old rules or the new ones, never a mix, without a lock.
+
+A new snapshot is built from the one in use: its engine is copied and
+only the lists that changed are applied to the copy, a refreshed list as
+the diff to its version in the old snapshot. The RulePacks of the lists
+are immutable, so snapshots share them.
+
+Usage:
+    rules = ListRules(pack, index_keys, content_hash, parser.cosmetic)
+    lists = dict(snapshot.lists, easylist=rules)
+    diffs = {"easylist": ListDiff(old_hash, added, added_keys, removed)}
+    snapshot = EngineSnapshot(lists, snapshot, diffs) # in a thread
+    rule, stamp = snapshot.engine.classify(url, options)
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+import sys
+import io
+import time
+import collections
+import logging as log
+
+from ruleengine import RuleEngine
+from cosmeticindex import CosmeticIndex
+
+NATIVE=sys.getfilesystemencoding()
+
+# The parsed rules of one filter list
+ListRules = collections.namedtuple("ListRules",
+        ["pack", "index_keys", "list_hash", "cosmetic"])
+
+# The change of a refreshed list from the version of list hash base_hash:
+# the RulePack of the added rules, their index keys and the rule_source()
+# of the removed rules
+ListDiff = collections.namedtuple("ListDiff",
+        ["base_hash", "added", "added_keys", "removed"])
+
+class EngineSnapshot:
+    """Rules of a set of filter lists, not changed once built"""
+    def __init__(self, lists=None, base=None, diffs=None):
+        """lists are list name -> ListRules.
+
+        base is the snapshot to build from, only the lists that differ
+        from it are indexed. diffs are list name -> ListDiff, a list with
+        a diff from its version in base is applied as that diff.
+        """
+        start = time.time()
+        self.lists = dict(lists or {})
+        names = sorted(self.lists)
+        if base is None:
+            self.engine = RuleEngine()
+            self.engine.add_lists([(x, self.lists[x].pack,
+                self.lists[x].index_keys, self.lists[x].list_hash)
+                for x in names])
+        else:
+            self.engine = self._apply(base, diffs or {})
+        self.cosmetic = CosmeticIndex()
+        self.cosmetic.add_lists([(x, self.lists[x].cosmetic) for x in names])
+        self.generation = self.engine.generation
+        self.stamps = self.engine.stamps()
+        self.build_time = time.time() - start
+
+    def _apply(self, base, diffs):
+        """Return a copy of the engine of base with the lists changed"""
+        engine = base.engine.copy()
+        for name in sorted(set(base.lists) - set(self.lists)):
+            engine.remove_list(name)
+        for name in sorted(self.lists):
+            rules = self.lists[name]
+            old_rules = base.lists.get(name)
+            if rules is old_rules:
+                continue
+            diff = diffs.get(name)
+            if (old_rules is not None and diff is not None
+                    and diff.base_hash == old_rules.list_hash):
+                engine.update_list(name, diff.added, diff.removed,
+                        diff.added_keys, rules.list_hash)
+            else:
+                engine.replace_list(name, rules.pack, rules.index_keys,
+                        rules.list_hash)
+        return engine
+
+    def __len__(self):
+        return len(self.engine)
+
+def main():
+    def set_stdio_encoding(enc=NATIVE):
+        import codecs; stdio = ["stdin", "stdout", "stderr"]
+        for x in stdio:
+            obj = getattr(sys, x)
+            if not obj.encoding: setattr(sys,  x, codecs.getwriter(enc)(obj))
+    set_stdio_encoding()
+
+    log_level = log.INFO
+    log.basicConfig(format="%(levelname)s>> %(message)s", level=log_level)
+
+    from filterparser import FilterParser
+    from rulestore import RulePack
+    lists = {}
+    for fname in sys.argv[1:]:
+        parser = FilterParser()
+        with io.open(fname, encoding="UTF-8") as fd:
+            rules, index_keys = parser.parse(fd)
+        lists[fname] = ListRules(RulePack.from_rules(rules), index_keys,
+                fname, parser.cosmetic)
+    snapshot = EngineSnapshot(lists)
+    print("{} rules, {} element hiding entries, generation {}, built in "
+            "{:.3f}s".format(len(snapshot), len(snapshot.cosmetic),
+                snapshot.generation, snapshot.build_time))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+#!/usr/bin/python3
+# vim:fileencoding=utf-8:sw=4:et
+#
+# Streaming parser of adblock filter files
+#
+# Copyright (C) 2015 Mozbugbox <mozbugbox@yahoo.com.au>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with this library; see the file COPYING.LIB.  If not, write to
+# the Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+#
+"""
+Read a filter file once, line by line. The `! Key: value` header
+comments at the top are collected as the file info, comments are
+skipped and element hiding lines are split into (domains, selector,
+is_exception) entries before any rule object is made, and the
+(rule, index key) of every network rule is yielded to the engine.
+
+Usage:
+    parser = FilterParser()
+    with io.open("easylist.txt", encoding="UTF-8") as fd:
+        rules = list(parser.iter_rules(fd))
+    parser.info     # {"last modified": 1437000000.0, "expires": 345600.0}
+    parser.counts   # {"host": 17000, "token": 9000, "comment": 12, ...}
+    parser.cosmetic # [((("example.com", True),), ".ad", False), ...]
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+import sys
+import io
+import re
+import time
+import logging as log
+
+from sys import intern
+
+import parsedate
+from adblockparserlite import AdblockRuleLite
+from ruleengine import rule_index_key
+
+NATIVE=sys.getfilesystemencoding()
+
+TIME_UNIT = {
+        "second": 1,
+        "minute": 60,
+        "hour": 3600,
+        "day": 3600*24,
+        }
+
+# The header is looked for in this many lines at the top of the file
+HEADER_LINES = 20
+
+# Procedural and other extended selectors that are not CSS. One of them
+# in a style sheet would void the selectors grouped with it.
+EXTENDED_SELECTOR_RE = re.compile(r":(?:-abp-[a-z-]+|has-text|xpath|"
+        r"matches-[a-z-]+|upward|remove|style|min-text-length|watch-attr|"
+        r"others|if|if-not|nth-ancestor|matches-path)\(")
+
+def is_comment(line):
+    """Test if a stripped filter line is a comment"""
+    return line.startswith(("!", "[Adblock"))
+
+def is_cosmetic(line):
+    """Test if a stripped filter line is an element hiding rule"""
+    return "##" in line or "#@#" in line
+
+def parse_cosmetic(line):
+    """Return (domains, selector, is_exception) of an element hiding rule.
+
+    domains is a tuple of (domain, include) pairs, empty for a generic
+    rule. None is returned for the rules that are not plain CSS.
+    """
+    is_exception = "#@#" in line
+    domains, s, selector = line.partition("#@#" if is_exception else "##")
+    selector = selector.strip()
+    if (not selector or selector.startswith(("+js(", "^"))
+            or EXTENDED_SELECTOR_RE.search(selector)):
+        return None
+    pairs = []
+    for d in domains.split(","):
+        d = d.strip().lower()
+        if not d:
+            continue
+        if d.startswith("~"):
+            pairs.append((intern(d[1:]), False))
+        else:
+            pairs.append((intern(d), True))
+    return tuple(pairs), selector, is_exception
+
+def parse_header_line(line):
+    """Return the (lower case key, value) of a header comment, or None"""
+    line = line.lstrip("!").lstrip()
+    k, s, v = line.partition(":")
+    if not s:
+        return None
+    klow = k.lower()
+    if klow == "last modified":
+        lmdate = parsedate.parse_date(v)
+        if lmdate:
+            v = lmdate
+        else:
+            v = time.time()
+    elif klow == "expires":
+        parts = v.strip().split()
+        try:
+            exdate = float(parts[0])
+            exunit = parts[1].lower().rstrip("s")
+            v = exdate * TIME_UNIT[exunit]
+        except (IndexError, ValueError, KeyError):
+            return None
+    return klow, v
+
+class FilterParser:
+    """Single pass parser of filter files"""
+    def __init__(self, supported_options=None, default_expires=None):
+        if supported_options is None:
+            supported_options = ["third-party"]
+        self._params = dict((opt, True) for opt in supported_options)
+        self.default_expires = default_expires
+        self.info = {}
+        self.counts = {}
+        self.cosmetic = []
+        self.parse_time = 0.0
+
+    def _count(self, kind):
+        self.counts[kind] = self.counts.get(kind, 0) + 1
+
+    def iter_rules(self, lines, skip=None):
+        """Yield (rule, rule_index_key()) for the rules of filter lines.
+
+        Lines in skip, stripped, are not parsed, e.g. the rules loaded
+        from an older version of the file. The element hiding rules are
+        collected in cosmetic. info, counts and parse_time are set once
+        all the lines are read.
+        """
+        self.info = {}
+        self.counts = {}
+        self.cosmetic = []
+        self.parse_time = 0.0
+        start = time.time()
+        in_header = True
+        for i, line in enumerate(lines):
+            line = line.strip()
+            if not line:
+                continue
+            if is_comment(line):
+                self._count("comment")
+                if in_header and i < HEADER_LINES:
+                    kv = parse_header_line(line)
+                    if kv is not None:
+                        self.info[kv[0]] = kv[1]
+                continue
+            in_header = False
+            if is_cosmetic(line):
+                entry = parse_cosmetic(line)
+                if entry is None:
+                    self._count("unsupported")
+                else:
+                    self._count("cosmetic")
+                    self.cosmetic.append(entry)
+                continue
+            if skip is not None and line in skip:
+                self._count("unchanged")
+                continue
+
+            rule = AdblockRuleLite(line)
+            if not ((rule.regex or rule.options)
+                    and rule.matching_supported(self._params)):
+                self._count("unsupported")
+                continue
+            index_key = rule_index_key(rule)
+            self._count(index_key[0] or "other")
+            if rule.is_exception:
+                self._count("exception")
+
+            # Leave the caller's time out of the parse time
+            self.parse_time += time.time() - start
+            yield rule, index_key
+            start = time.time()
+
+        self.parse_time += time.time() - start
+        if "last modified" not in self.info:
+            self.info["last modified"] = time.time()
+        if "expires" not in self.info and self.default_expires is not None:
+            self.info["expires"] = self.default_expires
+
+    def parse(self, lines, skip=None):
+        """Return ([rule], [rule_index_key()]) of filter lines"""
+        rules = []
+        index_keys = []
+        for rule, index_key in self.iter_rules(lines, skip):
+            rules.append(rule)
+            index_keys.append(index_key)
+        return rules, index_keys
+
+    def report(self):
+        """Return a one line summary of the last parse"""
+        counts = ", ".join("{} {}".format(k, v)
+                for k, v in sorted(self.counts.items()))
+        return "{:.3f}s: {}".format(self.parse_time, counts)
+
+def main():
+    def set_stdio_encoding(enc=NATIVE):
+        import codecs; stdio = ["stdin", "stdout", "stderr"]
+        for x in stdio:
+            obj = getattr(sys, x)
+            if not obj.encoding: setattr(sys,  x, codecs.getwriter(enc)(obj))
+    set_stdio_encoding()
+
+    log_level = log.INFO
+    log.basicConfig(format="%(levelname)s>> %(message)s", level=log_level)
+
+    for fname in sys.argv[1:]:
+        parser = FilterParser()
+        with io.open(fname, encoding="UTF-8") as fd:
+            rules, index_keys = parser.parse(fd)
+        print("{}: {} rules in {}".format(fname, len(rules), parser.report()))
+        for k, v in sorted(parser.info.items()):
+            print("  {}: {}".format(k, v))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+#!/usr/bin/python3
+# vim:fileencoding=utf-8:sw=4:et
+#
+# Counters and latency histogram of url lookups
+#
+# Copyright (C) 2015 Mozbugbox <mozbugbox@yahoo.com.au>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with this library; see the file COPYING.LIB.  If not, write to
+# the Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+#
+"""
+Count what happens to looked up urls, blocked or allowed, deferred or
+late, and keep a histogram of the engine lookup time. The counts are
+plain ints bumped without a lock, from the main thread and the classify
+threads, a lost update now and then does not matter for statistics.
+
+Usage:
+    stats = LookupStats()
+    stats.add_lookup(0.000120)
+    stats.count("blocked")
+    stats.as_dict() # {"counts": {"blocked": 1}, "latency": {...}}
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+import sys
+import io
+import json
+import time
+import bisect
+import logging as log
+
+NATIVE=sys.getfilesystemencoding()
+
+# Upper bounds of the latency buckets in microseconds, the last bucket
+# takes the rest
+LATENCY_BOUNDS_US = [10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000,
+        20000, 50000]
+PERCENTILES = [50, 95, 99]
+
+class LatencyHistogram:
+    """Counts of latencies by bucket"""
+    def __init__(self, bounds=LATENCY_BOUNDS_US):
+        self.bounds = list(bounds)
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        us = seconds * 1e6
+        self.counts[bisect.bisect_left(self.bounds, us)] += 1
+        self.count += 1
+        self.total += us
+        if us > self.max:
+            self.max = us
+
+    def percentile(self, p):
+        """Return the upper bound of the bucket holding percentile p"""
+        if not self.count:
+            return 0.0
+        rank = p / 100.0 * self.count
+        seen = 0
+        for bound, n in zip(self.bounds, self.counts):
+            seen += n
+            if seen >= rank:
+                return float(bound)
+        return self.max
+
+    def as_dict(self):
+        labels = ["<={}".format(x) for x in self.bounds]
+        labels.append(">{}".format(self.bounds[-1]))
+        result = {
+                "buckets_us": dict(zip(labels, self.counts)),
+                "count": self.count,
+                "mean_us": self.total / self.count if self.count else 0.0,
+                "max_us": self.max,
+                }
+        for p in PERCENTILES:
+            result["p{}_us".format(p)] = self.percentile(p)
+        return result
+
+class LookupStats:
+    """Lookup counters and the engine latency histogram"""
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.reset()
+
+    def reset(self):
+        self.counts = {}
+        self.latency.reset()
+        self.start_time = time.time()
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def add_lookup(self, seconds):
+        """Record the time of one engine lookup"""
+        self.latency.add(seconds)
+
+    def as_dict(self):
+        return {
+                "since": self.start_time,
+                "counts": dict(self.counts),
+                "latency": self.latency.as_dict(),
+                }
+
+def summary_rows(stats):
+    """Return (label, value text) rows of a stats dict for display"""
+    rows = []
+    counts = stats.get("counts", {})
+    blocked = counts.get("blocked", 0)
+    allowed = counts.get("allowed", 0)
+    rows.append(("Blocked / allowed", "{} / {}".format(blocked, allowed)))
+    for k, v in sorted(counts.items()):
+        if k not in ("blocked", "allowed"):
+            rows.append((k.capitalize().replace("-", " "), str(v)))
+
+    cache = stats.get("cache")
+    if cache:
+        rows.append(("Cache misses", str(cache["misses"])))
+        for tier in ["block", "unblock"]:
+            x = cache[tier]
+            rows.append(("Cache {} hits / stale".format(tier),
+                "{} / {}".format(x["hits"], x["stale"])))
+            rows.append(("Cache {} size".format(tier),
+                "{} of {}, {} evicted".format(x["entries"], x["capacity"],
+                    x["evictions"])))
+
+    engine = stats.get("engine")
+    if engine:
+        rows.append(("Rules loaded", str(engine["rules"])))
+        rows.append(("Engine lookups", str(engine["lookups"])))
+        rows.append(("Rules tested per engine lookup",
+            "{:.1f}".format(engine["rules_per_lookup"])))
+
+    latency = stats.get("latency", {})
+    rows.append(("Lookups timed", str(latency.get("count", 0))))
+    for k in ["mean_us", "p50_us", "p95_us", "p99_us", "max_us"]:
+        rows.append(("Lookup {} (us)".format(k[:-3]),
+            "{:.0f}".format(latency.get(k, 0.0))))
+    for k, v in sorted(latency.get("buckets_us", {}).items(),
+            key=lambda x: (x[0][0] == ">", int(x[0].lstrip("<=>")))):
+        rows.append(("  {} us".format(k), str(v)))
+    return rows
+
+def dump_stats(path, stats):
+    """Write a stats dict as JSON"""
+    with io.open(path, "w", encoding="UTF-8") as fdw:
+        fdw.write(json.dumps(stats, indent=2, sort_keys=True))
+        fdw.write("\n")
+
+def main():
+    def set_stdio_encoding(enc=NATIVE):
+        import codecs; stdio = ["stdin", "stdout", "stderr"]
+        for x in stdio:
+            obj = getattr(sys, x)
+            if not obj.encoding: setattr(sys,  x, codecs.getwriter(enc)(obj))
+    set_stdio_encoding()
+
+    log_level = log.INFO
+    log.basicConfig(format="%(levelname)s>> %(message)s", level=log_level)
+
+    # Print the summary of a stats dump
+    with io.open(sys.argv[1], encoding="UTF-8") as fd:
+        stats = json.load(fd)
+    for label, value in summary_rows(stats):
+        print("{:28s} {}".format(label, value))
+
+if __name__ == '__main__':
+    main()
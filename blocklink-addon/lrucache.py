@@ -19,6 +19,7 @@ class LRUCache:
         self._capacity = capacity
         self.cache = collections.OrderedDict()
         self._insert_count = 0
+        self._evict_count = 0
 
     def __len__(self):
         return len(self.cache)
@@ -37,9 +38,13 @@ class LRUCache:
         except KeyError:
             if len(self.cache) >= self._capacity:
                 self.cache.popitem(last=False)
+                self._evict_count += 1
         self.cache[key] = value
         self._insert_count += 1
 
+    def __delitem__(self, key):
+        del self.cache[key]
+
     @property
     def capacity(self):
         return self._capacity
@@ -54,14 +59,21 @@ class LRUCache:
     def insert_count(self):
         return self._insert_count
 
+    @property
+    def evict_count(self):
+        return self._evict_count
+
     def reset_insert_count(self):
         self._insert_count = 0
 
+    def reset_evict_count(self):
+        self._evict_count = 0
+
     def load(self, path):
         try:
             if os.path.exists(path):
                 with io.open(path, encoding="utf-8") as fd:
-                    cache_list = json.load(fd, encoding="UTF-8")
+                    cache_list = json.load(fd)
                     if len(cache_list) > self._capacity:
                         cache_list = cache_list[:self._capacity]
                     self.cache = collections.OrderedDict(cache_list)
@@ -70,10 +82,7 @@ class LRUCache:
 
     def save(self, path):
         cache_list = list(self.cache.items())
-        cache_str = json.dumps(cache_list,
-                encoding="utf-8", ensure_ascii=False)
-        if not isinstance(cache_str, unicode):
-            cache_str = unicode(cache_str, "UTF-8")
+        cache_str = json.dumps(cache_list, ensure_ascii=False)
         try:
 
             with io.open(path, "w", encoding="utf-8") as fdw:
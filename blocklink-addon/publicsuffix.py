@@ -0,0 +1,236 @@
+#!/usr/bin/python3
+# vim:fileencoding=utf-8:sw=4:et
+#
+# Registrable domains by the public suffix list
+#
+# Copyright (C) 2015 Mozbugbox <mozbugbox@yahoo.com.au>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with this library; see the file COPYING.LIB.  If not, write to
+# the Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+#
+"""
+Find the registrable domain, the eTLD+1, of a hostname with the public
+suffix list of publicsuffix.org, bundled as public_suffix_list.dat.
+
+The rules are compiled into a trie of nested dicts keyed by the labels
+from the right. Nodes without children are one shared leaf and the
+labels are interned, so the ~9000 rules take little memory. Finding
+the public suffix of a hostname is one walk from its last label. The
+compiled trie can be kept in a cache file, it loads much faster than
+the list is compiled.
+
+Two hostnames are the same party when they have the same registrable
+domain: cdn.example.co.uk is first party on www.example.co.uk, but
+a.github.io is third party on b.github.io.
+
+Usage:
+    suffixes = PublicSuffixList.load()
+    suffixes.registrable_domain("www.example.co.uk") # "example.co.uk"
+    suffixes.is_third_party("example.co.uk", "cdn.example.co.uk") # False
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+import sys
+import os
+import io
+import re
+import time
+import pickle
+import logging as log
+
+from sys import intern
+
+NATIVE=sys.getfilesystemencoding()
+
+PSL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        "public_suffix_list.dat")
+# Bump when the trie layout changes
+TRIE_VERSION = 1
+
+TERMINAL = "" # key marking a node that ends a rule
+LEAF = {TERMINAL: True} # shared by all the nodes without children
+WILDCARD = "*"
+EXCEPTION = "!"
+
+IP_RE = re.compile(r"^[0-9.]+$|:")
+
+class PublicSuffixList:
+    """Trie of public suffix rules"""
+    def __init__(self, rules=()):
+        self.root = {}
+        self.count = 0
+        for rule in rules:
+            self.add(rule)
+
+    @classmethod
+    def load(cls, path=PSL_PATH, cache_path=None):
+        """Return the list of a public_suffix_list.dat file.
+
+        The compiled trie is saved in cache_path, if given, and loaded
+        from it while the list file is unchanged.
+        """
+        start = time.time()
+        st = os.stat(path)
+        stamp = [TRIE_VERSION, st.st_size, st.st_mtime]
+        suffixes = None
+        if cache_path is not None:
+            suffixes = cls._load_trie(cache_path, stamp)
+        if suffixes is None:
+            with io.open(path, encoding="UTF-8") as fd:
+                suffixes = cls(read_rules(fd))
+            if cache_path is not None:
+                suffixes._save_trie(cache_path, stamp)
+        log.debug("Loaded {} public suffix rules in {:.3f}s".format(
+            suffixes.count, time.time() - start))
+        return suffixes
+
+    @classmethod
+    def _load_trie(cls, cache_path, stamp):
+        if not os.path.exists(cache_path):
+            return None
+        try:
+            with io.open(cache_path, "rb") as fd:
+                data = pickle.load(fd)
+        except Exception as e:
+            log.warning("Bad public suffix cache {}: {}".format(cache_path,
+                e))
+            return None
+        if data.get("stamp") != stamp:
+            return None
+        suffixes = cls()
+        suffixes.root = data["root"]
+        suffixes.count = data["count"]
+        return suffixes
+
+    def _save_trie(self, cache_path, stamp):
+        data = {"stamp": stamp, "root": self.root, "count": self.count}
+        tmp_path = cache_path + ".tmp"
+        try:
+            with io.open(tmp_path, "wb") as fdw:
+                pickle.dump(data, fdw, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, cache_path)
+        except (IOError, OSError, pickle.PicklingError) as e:
+            log.warning("Failed to save public suffix cache {}: {}".format(
+                cache_path, e))
+
+    def add(self, rule):
+        """Add a rule, e.g. `co.uk`, `*.ck` or `!www.ck`"""
+        is_exception = rule.startswith(EXCEPTION)
+        labels = rule.lstrip(EXCEPTION).split(".")[::-1]
+        node = self.root
+        for label in labels[:-1]:
+            label = intern(label)
+            child = node.get(label)
+            if child is None:
+                child = node[label] = {}
+            elif child is LEAF:
+                child = node[label] = dict(LEAF)
+            node = child
+
+        last = intern(labels[-1])
+        if is_exception:
+            last = intern(EXCEPTION + last)
+        child = node.get(last)
+        if child is None:
+            node[last] = LEAF
+        elif child is not LEAF:
+            child[TERMINAL] = True
+        self.count += 1
+
+    def suffix_length(self, labels):
+        """Return the number of labels of the public suffix of a hostname
+        given as reversed labels"""
+        node = self.root
+        length = 1 # an unlisted TLD is a public suffix
+        for i, label in enumerate(labels):
+            if EXCEPTION + label in node:
+                return i
+            if WILDCARD in node:
+                length = i + 1
+            node = node.get(label)
+            if node is None:
+                break
+            if TERMINAL in node:
+                length = i + 1
+        return length
+
+    def registrable_domain(self, host):
+        """Return the registrable domain of host.
+
+        A host that is an IP address or a public suffix itself is returned
+        as it is.
+        """
+        host = (host or "").lower().rstrip(".")
+        if not host or IP_RE.search(host):
+            return host
+        labels = host.split(".")
+        length = self.suffix_length(labels[::-1])
+        if length >= len(labels):
+            return host
+        return ".".join(labels[-length-1:])
+
+    def is_third_party(self, page_domain, host):
+        """Test if a request to host is third party on a page of the
+        registrable domain page_domain"""
+        host = (host or "").lower()
+        if host == page_domain:
+            return False
+        if not host.endswith("." + page_domain):
+            return True
+        # a subdomain may still be a registrable domain of its own, e.g.
+        # a bucket of a hosting service
+        return self.registrable_domain(host) != page_domain
+
+def read_rules(lines):
+    """Yield the rules of the lines of a public suffix list.
+
+    Rules with non-ASCII labels are given in their IDNA form too, as
+    hostnames are in URLs.
+    """
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("//"):
+            continue
+        rule = line.split()[0].lower()
+        yield rule
+        try:
+            rule.encode("ascii")
+        except UnicodeError:
+            prefix = EXCEPTION if rule.startswith(EXCEPTION) else ""
+            labels = rule.lstrip(EXCEPTION).split(".")
+            try:
+                labels = [x if x == WILDCARD else
+                        x.encode("idna").decode("ascii") for x in labels]
+            except UnicodeError:
+                continue
+            yield prefix + ".".join(labels)
+
+def main():
+    def set_stdio_encoding(enc=NATIVE):
+        import codecs; stdio = ["stdin", "stdout", "stderr"]
+        for x in stdio:
+            obj = getattr(sys, x)
+            if not obj.encoding: setattr(sys,  x, codecs.getwriter(enc)(obj))
+    set_stdio_encoding()
+
+    log_level = log.DEBUG
+    log.basicConfig(format="%(levelname)s>> %(message)s", level=log_level)
+
+    suffixes = PublicSuffixList.load()
+    for host in sys.argv[1:]:
+        print("{}: {}".format(host, suffixes.registrable_domain(host)))
+
+if __name__ == '__main__':
+    main()
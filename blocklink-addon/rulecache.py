@@ -0,0 +1,209 @@
+#!/usr/bin/python3
+# vim:fileencoding=utf-8:sw=4:et
+#
+# On-disk snapshot of parsed filter rules
+#
+# Copyright (C) 2015 Mozbugbox <mozbugbox@yahoo.com.au>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with this library; see the file COPYING.LIB.  If not, write to
+# the Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+#
+"""
+Save the parsed and indexed rules of a filter file next to it, so the
+next start can skip parsing when the filter file did not change.
+
+A snapshot is stamped with the size, mtime and content hash of the
+filter file it was built from and is ignored when the stamp does not
+match the file anymore.
+
+load_rules() gives the rules of a filter file either way, from the
+snapshot or parsed and saved as a new snapshot.
+
+The stamp is pickled ahead of the rules, so load_stamp() can tell the
+content hash of the rules without loading them.
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+import sys
+import os
+import io
+import hashlib
+import pickle
+import logging as log
+
+from filterparser import FilterParser
+from rulestore import RulePack, FLAG_EXCEPTION
+
+NATIVE=sys.getfilesystemencoding()
+
+# Bump when the pickled rule pack, index keys or cosmetic entries change
+SNAPSHOT_VERSION = 5
+SNAPSHOT_SUFFIX = ".snapshot"
+
+def file_hash(path):
+    """Return the sha1 hex digest of a file"""
+    sha = hashlib.sha1()
+    with io.open(path, "rb") as fd:
+        for chunk in iter(lambda: fd.read(65536), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def file_stamp(path, content_hash=None):
+    """Return the stamp identifying the current content of a file"""
+    st = os.stat(path)
+    if content_hash is None:
+        content_hash = file_hash(path)
+    return {"size": st.st_size, "mtime": st.st_mtime, "hash": content_hash}
+
+def snapshot_path(path):
+    """Return the snapshot filename of a filter file"""
+    return path + SNAPSHOT_SUFFIX
+
+def _read_header(fd, path):
+    """Read the header of the snapshot of filter file path from fd.
+
+    Return the header, or None if the snapshot does not match the size
+    and mtime of the file.
+    """
+    header = pickle.load(fd)
+    if not isinstance(header, dict):
+        return None
+    if header.get("version") != SNAPSHOT_VERSION:
+        return None
+    stamp = header.get("stamp", {})
+    st = os.stat(path)
+    if stamp.get("size") != st.st_size or stamp.get("mtime") != st.st_mtime:
+        return None
+    return header
+
+def load_stamp(path):
+    """Return the stamp of the snapshot of filter file path, or None.
+
+    Only the header of the snapshot is read and the file is not hashed,
+    the size and mtime of the file have to match. The stamp has
+    "exceptions" too, whether there are exception rules.
+    """
+    spath = snapshot_path(path)
+    if not os.path.exists(spath) or not os.path.exists(path):
+        return None
+    try:
+        with io.open(spath, "rb") as fd:
+            header = _read_header(fd, path)
+    except Exception as e:
+        log.warning("Bad rule snapshot {}: {}".format(spath, e))
+        return None
+    if header is None:
+        return None
+    return dict(header["stamp"], exceptions=header["exceptions"])
+
+def load_snapshot(path, content_hash=None):
+    """Return the snapshot saved for filter file path.
+
+    The snapshot is a dict of "rules", a RulePack, "index_keys", "info"
+    and "cosmetic", the element hiding entries. None is returned if there
+    is no snapshot or it is outdated.
+    content_hash saves hashing the file again when it is already known.
+    """
+    spath = snapshot_path(path)
+    if not os.path.exists(spath) or not os.path.exists(path):
+        return None
+    try:
+        with io.open(spath, "rb") as fd:
+            header = _read_header(fd, path)
+            if header is None:
+                return None
+            if content_hash is None:
+                content_hash = file_hash(path)
+            if header["stamp"].get("hash") != content_hash:
+                return None
+            snapshot = pickle.load(fd)
+    except Exception as e:
+        log.warning("Bad rule snapshot {}: {}".format(spath, e))
+        return None
+    snapshot.update(header)
+    return snapshot
+
+def save_snapshot(path, rules, index_keys, info, content_hash=None,
+        cosmetic=()):
+    """Save the RulePack of filter file path with the file stamp"""
+    header = {
+            "version": SNAPSHOT_VERSION,
+            "stamp": file_stamp(path, content_hash),
+            "exceptions": any(x & FLAG_EXCEPTION for x in rules.flags),
+            }
+    snapshot = {
+            "rules": rules,
+            "index_keys": index_keys,
+            "info": info,
+            "cosmetic": list(cosmetic),
+            }
+    spath = snapshot_path(path)
+    tmp_path = spath + ".tmp"
+    try:
+        with io.open(tmp_path, "wb") as fdw:
+            pickle.dump(header, fdw, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(snapshot, fdw, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, spath)
+    except (IOError, OSError, pickle.PicklingError) as e:
+        log.warning("Failed to save rule snapshot {}: {}".format(spath, e))
+
+def load_rules(path, content_hash=None, default_expires=None):
+    """Return the rules of filter file path as a snapshot dict.
+
+    The file is parsed and a new snapshot saved if there is no valid one.
+    The dict is then the one load_snapshot() would return plus "report",
+    the parser report.
+    """
+    snapshot = load_snapshot(path, content_hash)
+    if snapshot is not None:
+        return snapshot
+    if content_hash is None:
+        content_hash = file_hash(path)
+    parser = FilterParser(default_expires=default_expires)
+    with io.open(path, encoding="UTF-8") as fd:
+        rules, index_keys = parser.parse(fd)
+    pack = RulePack.from_rules(rules)
+    save_snapshot(path, pack, index_keys, parser.info, content_hash,
+            parser.cosmetic)
+    return {
+            "version": SNAPSHOT_VERSION,
+            "stamp": {"hash": content_hash},
+            "rules": pack,
+            "index_keys": index_keys,
+            "info": parser.info,
+            "cosmetic": list(parser.cosmetic),
+            "report": parser.report(),
+            }
+
+def main():
+    def set_stdio_encoding(enc=NATIVE):
+        import codecs; stdio = ["stdin", "stdout", "stderr"]
+        for x in stdio:
+            obj = getattr(sys, x)
+            if not obj.encoding: setattr(sys,  x, codecs.getwriter(enc)(obj))
+    set_stdio_encoding()
+
+    log_level = log.INFO
+    log.basicConfig(format="%(levelname)s>> %(message)s", level=log_level)
+
+    for path in sys.argv[1:]:
+        snapshot = load_snapshot(path)
+        if snapshot is None:
+            print("{}: no valid snapshot".format(path))
+        else:
+            print("{}: {} rules".format(path, len(snapshot["rules"])))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,909 @@
+#!/usr/bin/python3
+# vim:fileencoding=utf-8:sw=4:et
+#
+# Combined, token indexed matching engine for adblock rules
+#
+# Copyright (C) 2015 Mozbugbox <mozbugbox@yahoo.com.au>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with this library; see the file COPYING.LIB.  If not, write to
+# the Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+#
+"""
+Match URLs against the rules of all the active filter lists at once.
+
+Every rule is filed under one token of its pattern, the way uBlock does
+it. A URL is split into tokens and only the rules filed under one of
+those tokens are tested, so the lookup cost depends on how many rules
+share a token with the URL, not on the number of loaded rules.
+
+`||hostname^` rules, the bulk of most lists, are kept in a dict by
+hostname instead. A lookup walks the suffixes of the URL hostname and
+needs no regex at all.
+
+Plain substring rules, and rules that have no usable token, are found
+by their longest literal part with one Aho-Corasick pass over the URL.
+Plain substrings need no regex, the others only run theirs when the
+literal is in the URL.
+
+Most URLs are not blocked at all. The hostnames and tokens that every
+blocking rule needs are collected in one set of triggers, and a URL
+without any trigger skips all but the few rules that have none. Those
+rules need a literal instead, and its first chars, the gram, go in a
+second set. may_block() only looks the URL up in the two sets.
+
+The rules themselves are kept packed in a RuleStore, see rulestore.py,
+and the engine only refers to them by rule id.
+
+An engine in use is not changed. A change of the lists is applied to a
+copy(), see enginesnapshot.py: a refreshed list as a diff with
+update_list(). Literals of the added rules are tested one by one until
+there are enough of them to be worth rebuilding the automaton.
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+import sys
+import io
+import re
+import hashlib
+import logging as log
+
+from ahocorasick import Automaton
+from adblockparserlite import AdblockRuleLite
+from rulestore import RuleStore, RulePack
+
+NATIVE=sys.getfilesystemencoding()
+
+# Tokens are runs of the chars the `^` separator does not match on
+TOKEN_RE = re.compile(r"[0-9a-z%]+")
+
+# `||hostname^` rules, matched without a regex
+HOST_RULE_RE = re.compile(r"^\|\|([0-9a-z_-]+(?:\.[0-9a-z_-]+)*)\^$")
+
+# Literal parts of a rule pattern are separated by these
+LITERAL_SPLIT_RE = re.compile(r"[*^|]+")
+MIN_LITERAL_LENGTH = 3
+# Length of the literal starts that stand in for the trigger of rules
+# without one
+GRAM_LENGTH = MIN_LITERAL_LENGTH
+
+# Literals added by list updates that are tested one by one before the
+# automaton is rebuilt
+MAX_PENDING_LITERALS = 64
+
+# Length of the list hash and generation stamps of verdicts
+STAMP_LENGTH = 16
+
+# Tokens found in too many URLs to narrow down the candidate rules
+BAD_TOKENS = frozenset([
+    "http", "https", "www", "com", "net", "org", "js", "css", "html",
+    "htm", "php", "jpg", "png", "gif", "static", "cdn",
+    ])
+
+def url_tokens(url):
+    """Return the set of tokens of a url"""
+    return set(TOKEN_RE.findall(url.lower()))
+
+def rule_token(rule_text):
+    """Return the best token to index a rule pattern by, or None.
+
+    A token is only usable when the pattern pins both of its ends to a
+    token boundary, otherwise the token could be part of a longer token
+    in the URL. `*` and an unanchored pattern end do not pin anything.
+    """
+    text = rule_text.lower()
+    if len(text) > 1 and text.startswith("/") and text.endswith("/"):
+        return None # regex rule
+
+    anchor_start = anchor_end = False
+    if text.startswith("||"):
+        text = text[2:]
+        anchor_start = True
+    elif text.startswith("|"):
+        text = text[1:]
+        anchor_start = True
+    if text.endswith("|"):
+        text = text[:-1]
+        anchor_end = True
+
+    best = None
+    best_score = -1
+    for m in TOKEN_RE.finditer(text):
+        start, end = m.span()
+        if start > 0:
+            if text[start - 1] == "*":
+                continue
+        elif not anchor_start:
+            continue
+        if end < len(text):
+            if text[end] == "*":
+                continue
+        elif not anchor_end:
+            continue
+
+        token = m.group()
+        score = len(token)
+        if token not in BAD_TOKENS:
+            score += 1000
+        if score > best_score:
+            best = token
+            best_score = score
+    return best
+
+def rule_host(rule_text):
+    """Return the hostname of a `||hostname^` rule, or None"""
+    m = HOST_RULE_RE.match(rule_text.lower())
+    if m is None:
+        return None
+    return m.group(1)
+
+def url_host(url):
+    """Return the lower case hostname of a url"""
+    start = url.find("://")
+    if start < 0:
+        return ""
+    start += 3
+    end = len(url)
+    for c in "/?#":
+        pos = url.find(c, start, end)
+        if pos >= 0:
+            end = pos
+    netloc = url[start:end].rpartition("@")[2]
+    return netloc.partition(":")[0].lower()
+
+def host_suffixes(host):
+    """Yield a hostname and its parent domains, a.b.c, b.c, c"""
+    while host:
+        yield host
+        host = host.partition(".")[2]
+
+def rule_literal(rule_text):
+    """Return the longest literal part of a rule pattern, or None"""
+    text = rule_text.lower()
+    if len(text) > 1 and text.startswith("/") and text.endswith("/"):
+        return None # regex rule
+    literal = max(LITERAL_SPLIT_RE.split(text), key=len)
+    if len(literal) < MIN_LITERAL_LENGTH:
+        return None
+    return literal
+
+def regex_literal(pattern):
+    """Return the longest literal a `/regex/` rule pattern needs, or None.
+
+    Only runs of plain chars outside of groups and classes count, a char
+    followed by a quantifier is not needed. A top level `|` leaves nothing
+    every match needs.
+    """
+    text = pattern[1:-1].lower()
+    runs = [[]]
+    depth = 0
+    i = 0
+    while i < len(text):
+        c = text[i]
+        i += 1
+        if c == "\\":
+            c = text[i:i+1]
+            i += 1
+            if c and not c.isalnum() and depth == 0:
+                runs[-1].append(c)
+                continue
+        elif c == "[":
+            if text[i:i+1] == "]":
+                i += 1
+            end = text.find("]", i)
+            i = len(text) if end < 0 else end + 1
+        elif c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif c == "|":
+            if depth == 0:
+                return None
+        elif c in "*?{":
+            if c == "{":
+                end = text.find("}", i)
+                i = len(text) if end < 0 else end + 1
+            if runs[-1]:
+                runs[-1].pop()
+        elif c == "+":
+            # one or more: the char starts the next run again
+            runs.append(runs[-1][-1:])
+            continue
+        elif c not in ".^$" and depth == 0:
+            runs[-1].append(c)
+            continue
+        if runs[-1]:
+            runs.append([])
+    literal = max(("".join(x) for x in runs), key=len)
+    if len(literal) < MIN_LITERAL_LENGTH:
+        return None
+    return literal
+
+def rule_gram(pattern, index_key):
+    """Return the start of a literal every URL a rule without trigger
+    matches has, or None.
+
+    Such rules are found by the literal automaton or tested for every
+    URL, see RuleEngine.may_block().
+    """
+    kind, key, trigger = index_key
+    if kind in (INDEX_PLAIN, INDEX_LITERAL):
+        literal = key
+    elif len(pattern) > 1 and pattern.startswith("/") and (
+            pattern.endswith("/")):
+        literal = regex_literal(pattern)
+    else:
+        literal = None
+    if literal is None:
+        return None
+    return literal[:GRAM_LENGTH]
+
+def rule_source(rule):
+    """Return the filter line of a rule, identifies the rule in its list"""
+    return rule.raw_rule_text.strip()
+
+def canonical_source(source):
+    """Return the canonical form of a filter line, the same for equal rules.
+
+    Options are lower cased, deduplicated and sorted, as are the domains
+    of a domain= option. The pattern is lower cased unless it is a regex
+    or has match-case.
+    """
+    prefix = "@@" if source.startswith("@@") else ""
+    pattern, s, options = source[len(prefix):].partition("$")
+    opts = set()
+    for x in options.split(","):
+        x = x.strip().lower()
+        if x.startswith("domain="):
+            x = "domain=" + "|".join(sorted(set(x[7:].split("|"))))
+        if x:
+            opts.add(x)
+    is_regex = len(pattern) > 1 and pattern.startswith("/") and (
+            pattern.endswith("/"))
+    if not is_regex and "match-case" not in opts:
+        pattern = pattern.lower()
+    if opts:
+        return prefix + pattern + "$" + ",".join(sorted(opts))
+    return prefix + pattern
+
+def is_plain_rule(rule):
+    """Test if a rule pattern is a case-insensitive plain substring"""
+    text = rule.rule_text
+    if "match-case" in rule.options:
+        return False
+    if len(text) > 1 and text.startswith("/") and text.endswith("/"):
+        return False
+    return (len(text) >= MIN_LITERAL_LENGTH
+            and LITERAL_SPLIT_RE.search(text) is None)
+
+# Kinds of index a rule can be filed in
+INDEX_HOST = "host"
+INDEX_PLAIN = "plain"     # in the automaton, matched without regex
+INDEX_TOKEN = "token"
+INDEX_LITERAL = "literal" # in the automaton, confirmed by regex
+INDEX_NONE = None
+
+def rule_index_key(rule):
+    """Return the (index kind, key, trigger) a rule is filed under.
+
+    trigger is a hostname or token every URL the rule matches must have,
+    or None if the rule has no such thing.
+    """
+    text = rule.rule_text
+    key = rule_host(text)
+    if key is not None:
+        return (INDEX_HOST, key, key)
+    if is_plain_rule(rule):
+        return (INDEX_PLAIN, text.lower(), rule_token(text))
+    key = rule_token(text)
+    if key is not None:
+        return (INDEX_TOKEN, key, key)
+    key = rule_literal(text)
+    if key is not None:
+        return (INDEX_LITERAL, key, rule_token(text))
+    return (INDEX_NONE, None, None)
+
+def generation_of(list_hashes):
+    """Return the generation stamp of a set of list hashes"""
+    sha = hashlib.sha1("|".join(sorted(list_hashes)).encode("UTF-8"))
+    return sha.hexdigest()[:STAMP_LENGTH]
+
+def stamps_of(list_hashes, exception_lists):
+    """Return (generation, list name -> block stamp) of a set of lists.
+
+    list_hashes are list name -> list hash, exception_lists the names of
+    the lists with exception rules.
+    """
+    list_hashes = dict((x, h[:STAMP_LENGTH]) for x, h in list_hashes.items())
+    generation = generation_of(list_hashes.values())
+    exception_stamp = generation_of(list_hashes[x] for x in exception_lists)
+    block_stamps = dict((x, block_stamp_of(h, exception_stamp))
+            for x, h in list_hashes.items())
+    return generation, block_stamps
+
+def block_stamp_of(list_hash, exception_stamp):
+    """Return the stamp of the block verdicts of a list's rules.
+
+    exception_stamp is the generation of the lists with exception rules,
+    any of which may allow a url the list blocks.
+    """
+    sha = hashlib.sha1("{}@@{}".format(list_hash,
+        exception_stamp).encode("UTF-8"))
+    return sha.hexdigest()[:STAMP_LENGTH]
+
+class RuleIndex:
+    """Index of either the blocking or the exception rules"""
+    def __init__(self):
+        # `||hostname^` rules are matched structurally by looking up the
+        # suffixes of the URL hostname: hostname -> [rule id]
+        self.hosts = {}
+        # token -> [rule id]
+        self.tokens = {}
+        # literal -> [rule id]. Plain substring rules and rules without a
+        # usable token are found by one automaton pass over the URL.
+        self.literals = {}
+        self.automaton = None
+        self.automaton_literals = frozenset()
+        # Literals added after the automaton was built, tested one by one
+        self.pending = frozenset()
+        # Rules with nothing to index, tested for every URL
+        self.untokenized = []
+
+    def copy(self):
+        """Return a copy to change, sharing the built automaton"""
+        index = RuleIndex()
+        for name in ["hosts", "tokens", "literals"]:
+            setattr(index, name, dict((k, list(v))
+                for k, v in getattr(self, name).items()))
+        index.automaton = self.automaton
+        index.automaton_literals = self.automaton_literals
+        index.pending = self.pending
+        index.untokenized = list(self.untokenized)
+        return index
+
+    def container(self, kind):
+        """Return the dict or list a kind of rule is filed in"""
+        if kind == INDEX_HOST:
+            return self.hosts
+        if kind == INDEX_TOKEN:
+            return self.tokens
+        if kind in (INDEX_PLAIN, INDEX_LITERAL):
+            return self.literals
+        return self.untokenized
+
+    def build_automaton(self):
+        """Rebuild the literal automaton after the literals changed"""
+        self.pending = frozenset()
+        self.automaton_literals = frozenset(self.literals)
+        if not self.literals:
+            self.automaton = None
+            return
+        automaton = Automaton()
+        for literal in self.literals:
+            automaton.add(literal, literal)
+        automaton.build()
+        self.automaton = automaton
+
+    def add_pending(self, literals):
+        """Make newly filed literals findable without a full rebuild"""
+        pending = set(x for x in self.pending if x in self.literals)
+        pending.update(x for x in literals
+                if x not in self.automaton_literals and x in self.literals)
+        if len(pending) > MAX_PENDING_LITERALS:
+            self.build_automaton()
+        else:
+            self.pending = frozenset(pending)
+
+    def literal_matches(self, lower_url):
+        """Yield the literals found in a lower case URL"""
+        literals = self.literals
+        if self.automaton is not None:
+            seen = set()
+            for literal in self.automaton.iter_matches(lower_url):
+                if literal in seen or literal not in literals:
+                    continue
+                seen.add(literal)
+                yield literal
+        for literal in self.pending:
+            if literal in lower_url:
+                yield literal
+
+class RuleEngine:
+    """Rules of several filter lists merged into one index"""
+    def __init__(self):
+        self.store = RuleStore() # rule id -> packed rule
+        self.rule_keys = []   # rule id -> rule_index_key() of the rule
+        self.lists = {}       # list name -> set of rule ids
+        self.rule_lists = []  # rule id -> names of the lists of the rule
+        # hash of canonical_source() -> rule id, finds the rule a list
+        # shares with the lists loaded before
+        self.rule_ids = {}
+        self._owners = {}     # list name -> (list name,), shared tuples
+        self.list_hashes = {} # list name -> content hash of the list
+        self.exception_counts = {} # list name -> number of exception rules
+        self.generation = generation_of([])
+        self.block_stamps = {} # list name -> stamp of its block verdicts
+
+        self.block = RuleIndex()
+        self.allow = RuleIndex()
+        # Triggers of the blocking rules. For a URL without any of them
+        # only the blocking rules without a trigger need to be tested.
+        self.triggers = frozenset()
+        self.trigger_counts = {} # trigger -> number of blocking rules
+        # Blocking rules without a trigger stand in with rule_gram(), a
+        # URL without any of the grams is not blocked by them either
+        self.grams = frozenset()
+        self.gram_counts = {} # gram -> number of blocking rules
+        self.untriggered = 0  # blocking rules with neither
+        # for statistics: lookups and the rules they tested
+        self.lookups = 0
+        self.rules_tested = 0
+
+    def __len__(self):
+        return len(self.store)
+
+    def _pack(self, rules, index_keys):
+        """Return (RulePack, index keys) of rule objects or a pack"""
+        if isinstance(rules, RulePack):
+            if index_keys is None:
+                index_keys = [rule_index_key(AdblockRuleLite(x))
+                        for x in rules.sources()]
+            return rules, index_keys
+        if index_keys is None:
+            index_keys = [rule_index_key(r) for r in rules]
+        return RulePack.from_rules(rules), index_keys
+
+    def add_list(self, name, rules, index_keys=None, list_hash=None):
+        """Add the rules of a filter list, replacing an older version
+
+        rules are a RulePack or rule objects. index_keys are the
+        rule_index_key() of the rules, when the caller already has them.
+        list_hash identifies the content of the list, the list name is used
+        if not given.
+        """
+        self.add_lists([(name, rules, index_keys, list_hash)])
+
+    def add_lists(self, lists):
+        """Add several filter lists, rebuilding the automata only once
+
+        lists are (name, rules, index keys, list hash) as taken by
+        add_list().
+        """
+        for name, rules, index_keys, list_hash in lists:
+            if name in self.lists:
+                self._remove_list(name)
+            pack, index_keys = self._pack(rules, index_keys)
+            self.lists[name] = set()
+            self._attach(name, pack, index_keys)
+            self.list_hashes[name] = (list_hash or name)[:STAMP_LENGTH]
+        self._rebuild()
+
+    def copy(self):
+        """Return a copy of the engine to apply changes to.
+
+        The packs and the compiled regexes of the rules are shared, only
+        the containers are copied.
+        """
+        engine = RuleEngine()
+        engine.store = self.store.copy()
+        engine.rule_keys = list(self.rule_keys)
+        engine.lists = dict((k, set(v)) for k, v in self.lists.items())
+        engine.rule_lists = list(self.rule_lists)
+        engine.rule_ids = dict(self.rule_ids)
+        engine._owners = dict(self._owners)
+        engine.list_hashes = dict(self.list_hashes)
+        engine.exception_counts = dict(self.exception_counts)
+        engine.generation = self.generation
+        engine.block_stamps = dict(self.block_stamps)
+        engine.block = self.block.copy()
+        engine.allow = self.allow.copy()
+        engine.triggers = self.triggers
+        engine.trigger_counts = dict(self.trigger_counts)
+        engine.grams = self.grams
+        engine.gram_counts = dict(self.gram_counts)
+        engine.untriggered = self.untriggered
+        return engine
+
+    def update_list(self, name, added, removed, index_keys=None,
+            list_hash=None):
+        """Apply the change of a refreshed filter list in place
+
+        added are the new rules of the list, a RulePack or rule objects,
+        and removed the rule_source() of the rules gone from it. The work
+        done depends on the size of the change, not on the size of the list.
+        """
+        rids = self.lists.setdefault(name, set())
+        pack, index_keys = self._pack(added, index_keys)
+        # a rule may be removed and added again spelled another way
+        added_canon = set(canonical_source(x) for x in pack.sources())
+        gone = []
+        for canon in set(canonical_source(x) for x in removed):
+            if canon in added_canon:
+                continue
+            rid = self._rule_id(canon)
+            if rid is not None and rid in rids:
+                gone.append(rid)
+        self._detach(name, gone)
+
+        new_rids = self._attach(name, pack, index_keys)
+        self.list_hashes[name] = (list_hash or name)[:STAMP_LENGTH]
+        self._changed(new_rids)
+
+    def replace_list(self, name, rules, index_keys=None, list_hash=None):
+        """Replace all the rules of a filter list in place"""
+        if name in self.lists:
+            self._remove_list(name)
+        pack, index_keys = self._pack(rules, index_keys)
+        self.lists[name] = set()
+        new_rids = self._attach(name, pack, index_keys)
+        self.list_hashes[name] = (list_hash or name)[:STAMP_LENGTH]
+        self._changed(new_rids)
+
+    def remove_list(self, name):
+        """Remove all the rules of a filter list"""
+        self._remove_list(name)
+        self._changed([])
+
+    def _changed(self, new_rids):
+        """Make new rules findable and update the triggers and stamps
+        after a change in place"""
+        new_literals = {True: set(), False: set()}
+        for rid in new_rids:
+            kind, key, trigger = self.rule_keys[rid]
+            if kind in (INDEX_PLAIN, INDEX_LITERAL):
+                new_literals[self.store.is_exception(rid)].add(key)
+        self.allow.add_pending(new_literals[True])
+        self.block.add_pending(new_literals[False])
+        self.triggers = frozenset(self.trigger_counts)
+        self.grams = frozenset(self.gram_counts)
+        self._update_stamps()
+
+    def _remove_list(self, name):
+        """Remove all the rules of a filter list from the indices"""
+        rids = self.lists.get(name, set())
+        self._detach(name, list(rids))
+        del self.lists[name]
+        self.list_hashes.pop(name, None)
+        self.exception_counts.pop(name, None)
+        self._owners.pop(name, None)
+
+    def _rule_id(self, canon):
+        """Return the id of the rule of a canonical_source(), or None"""
+        rid = self.rule_ids.get(hash(canon))
+        if rid is None:
+            return None
+        if canonical_source(self.store.source(rid)) != canon:
+            return None # hash collision
+        return rid
+
+    def _owner(self, name):
+        """Return the rule_lists entry of a rule only in list name"""
+        owner = self._owners.get(name)
+        if owner is None:
+            owner = self._owners[name] = (name,)
+        return owner
+
+    def _attach(self, name, pack, index_keys):
+        """Add the rules of pack to list name.
+
+        Rules already loaded by any list are shared, only the new ones are
+        filed in the index. Return the ids of the new rules.
+        """
+        rids = self.lists[name]
+        rule_lists = self.rule_lists
+        store = self.store
+        exceptions = 0
+        seen = set()
+        positions = []
+        canons = []
+        for pos, source in enumerate(pack.sources()):
+            canon = canonical_source(source)
+            if canon in seen:
+                continue
+            seen.add(canon)
+            rid = self._rule_id(canon)
+            if rid is None:
+                positions.append(pos)
+                canons.append(canon)
+            elif rid not in rids:
+                rids.add(rid)
+                rule_lists[rid] = rule_lists[rid] + (name,)
+                if store.is_exception(rid):
+                    exceptions += 1
+
+        new_rids = self._add_rules(pack, positions, index_keys, name)
+        for rid, canon in zip(new_rids, canons):
+            self.rule_ids.setdefault(hash(canon), rid)
+            if store.is_exception(rid):
+                exceptions += 1
+        rids.update(new_rids)
+        self.exception_counts[name] = (
+                self.exception_counts.get(name, 0) + exceptions)
+        return new_rids
+
+    def _detach(self, name, rids):
+        """Drop rules from list name, removing those no other list has"""
+        self.lists[name].difference_update(rids)
+        rule_lists = self.rule_lists
+        store = self.store
+        gone = []
+        for rid in rids:
+            if store.is_exception(rid):
+                self.exception_counts[name] -= 1
+            owners = rule_lists[rid]
+            if len(owners) == 1:
+                gone.append(rid)
+                continue
+            owners = tuple(x for x in owners if x != name)
+            if len(owners) == 1:
+                owners = self._owner(owners[0])
+            rule_lists[rid] = owners
+        self._remove_rules(gone)
+
+    def _remove_rules(self, rids):
+        """Remove rules by id from the indices"""
+        removed = {}
+        rule_keys = self.rule_keys
+        store = self.store
+        for rid in rids:
+            key = hash(canonical_source(store.source(rid)))
+            if self.rule_ids.get(key) == rid:
+                del self.rule_ids[key]
+            is_exception = store.is_exception(rid)
+            kind, key, trigger = rule_keys[rid]
+            removed.setdefault((is_exception, kind, key), set()).add(rid)
+            if not is_exception:
+                self._count_trigger(rid, rule_keys[rid], -1)
+            rule_keys[rid] = None
+            self.rule_lists[rid] = None
+            store.remove(rid)
+
+        for (is_exception, kind, key), rid_set in removed.items():
+            index = self.allow if is_exception else self.block
+            container = index.container(kind)
+            if kind is INDEX_NONE:
+                bucket = container
+            else:
+                bucket = container.get(key)
+                if bucket is None:
+                    continue
+            bucket[:] = [x for x in bucket if x not in rid_set]
+            if kind is not INDEX_NONE and not bucket:
+                del container[key]
+
+    def _rebuild(self):
+        """Rebuild the literal automata and triggers after a change"""
+        for index in (self.block, self.allow):
+            index.build_automaton()
+        self.triggers = frozenset(self.trigger_counts)
+        self.grams = frozenset(self.gram_counts)
+        self._update_stamps()
+
+    def _update_stamps(self):
+        """Derive the verdict stamps from the list hashes after a change"""
+        self.generation, self.block_stamps = stamps_of(self.list_hashes,
+                [x for x, count in self.exception_counts.items() if count])
+
+    def stamps(self):
+        """Return the verdict stamps that are valid for the current rules"""
+        return frozenset(self.block_stamps.values()) | {self.generation}
+
+    def _add_rules(self, pack, positions, index_keys, list_name):
+        """File the rules of pack at positions in the index.
+
+        Return their rule ids.
+        """
+        store = self.store
+        rids = store.add_pack(pack, positions)
+        rule_keys = self.rule_keys
+        for rid, pos in zip(rids, positions):
+            index_key = index_keys[pos]
+            kind, key, trigger = index_key
+            owner = self._owner(list_name)
+            if rid == len(rule_keys):
+                rule_keys.append(index_key)
+                self.rule_lists.append(owner)
+            else:
+                rule_keys[rid] = index_key
+                self.rule_lists[rid] = owner
+
+            is_exception = store.is_exception(rid)
+            if not is_exception:
+                self._count_trigger(rid, index_key, 1)
+
+            index = self.allow if is_exception else self.block
+            container = index.container(kind)
+            if kind is INDEX_NONE:
+                container.append(rid)
+            else:
+                container.setdefault(key, []).append(rid)
+        return rids
+
+    def _count_trigger(self, rid, index_key, step):
+        """Count the trigger, or else the gram, of a blocking rule being
+        added (step 1) or removed (step -1)"""
+        trigger = index_key[2]
+        if trigger is not None:
+            counts = self.trigger_counts
+        else:
+            trigger = rule_gram(self.store.pattern(rid), index_key)
+            counts = self.gram_counts
+            if trigger is None:
+                self.untriggered += step
+                return
+        count = counts.get(trigger, 0) + step
+        if count:
+            counts[trigger] = count
+        else:
+            del counts[trigger]
+
+    def _find(self, index, url, lower_url, host, tokens, options,
+            triggered=True):
+        """Return the id of the first rule from index that matches url
+
+        Without triggered, only the rules without a trigger are tested.
+        """
+        store = self.store
+        rule_keys = self.rule_keys
+        tested = 0
+        try:
+            if index.hosts and triggered:
+                hosts = index.hosts
+                for suffix in host_suffixes(host):
+                    bucket = hosts.get(suffix)
+                    if bucket is None:
+                        continue
+                    for rid in bucket:
+                        tested += 1
+                        if store.options_match(rid, options):
+                            return rid
+
+            index_tokens = index.tokens if triggered else {}
+            for token in tokens:
+                bucket = index_tokens.get(token)
+                if bucket is None:
+                    continue
+                for rid in bucket:
+                    tested += 1
+                    if store.matches(rid, url, options):
+                        return rid
+
+            if index.literals:
+                for literal in index.literal_matches(lower_url):
+                    for rid in index.literals.get(literal, ()):
+                        kind, key, trigger = rule_keys[rid]
+                        if not triggered and trigger is not None:
+                            continue
+                        tested += 1
+                        if kind == INDEX_PLAIN:
+                            if store.options_match(rid, options):
+                                return rid
+                        elif store.matches(rid, url, options):
+                            return rid
+
+            for rid in index.untokenized:
+                tested += 1
+                if store.matches(rid, url, options):
+                    return rid
+            return None
+        finally:
+            self.rules_tested += tested
+
+    def _triggered(self, host, tokens):
+        """Test if a URL has any of the rule triggers"""
+        triggers = self.triggers
+        if not triggers.isdisjoint(tokens):
+            return True
+        for suffix in host_suffixes(host):
+            if suffix in triggers:
+                return True
+        return False
+
+    def _has_gram(self, lower_url):
+        """Test if a lower case URL has any of the grams"""
+        grams = self.grams
+        if not grams:
+            return False
+        for i in range(len(lower_url) - GRAM_LENGTH + 1):
+            if lower_url[i:i+GRAM_LENGTH] in grams:
+                return True
+        return False
+
+    def may_block(self, url, options=None):
+        """Quick test: False means url is surely not blocked.
+
+        Only looks the URL up in the trigger and gram sets, no rule is
+        tested. Rules with neither make every URL a maybe.
+        """
+        if self.untriggered:
+            return True
+        lower_url = url.lower()
+        if self._triggered(url_host(url), set(TOKEN_RE.findall(lower_url))):
+            return True
+        return self._has_gram(lower_url)
+
+    def _match(self, url, options):
+        """Return the id of the rule blocking url, or None"""
+        self.lookups += 1
+        options = options or {}
+        lower_url = url.lower()
+        host = url_host(url)
+        tokens = set(TOKEN_RE.findall(lower_url))
+        rid = self._find(self.block, url, lower_url, host, tokens, options,
+                self._triggered(host, tokens))
+        if rid is None:
+            return None
+        if self._find(self.allow, url, lower_url, host, tokens,
+                options) is not None:
+            return None
+        return rid
+
+    def match(self, url, options=None):
+        """Return the rule blocking url, or None if url is not blocked"""
+        rid = self._match(url, options)
+        if rid is None:
+            return None
+        return self.store.rule(rid)
+
+    def classify(self, url, options=None):
+        """Return (blocking rule or None, verdict stamp) for url.
+
+        A block verdict depends on the list of the blocking rule and on
+        the exception rules of every list. It is stamped with the hash of
+        that list folded with the hashes of the lists that have exception
+        rules, see block_stamp_of(). A rule of several lists is stamped
+        with the first of them, the rule stays while that list is
+        unchanged. Other verdicts depend on all the lists and are stamped
+        with the generation of the whole rule set.
+        """
+        rid = self._match(url, options)
+        if rid is None:
+            return None, self.generation
+        return (self.store.rule(rid),
+                self.block_stamps[self.rule_lists[rid][0]])
+
+    def should_block(self, url, options=None):
+        """Test if a url is blocked by any of the rules"""
+        return self._match(url, options) is not None
+
+def main():
+    def set_stdio_encoding(enc=NATIVE):
+        import codecs; stdio = ["stdin", "stdout", "stderr"]
+        for x in stdio:
+            obj = getattr(sys, x)
+            if not obj.encoding: setattr(sys,  x, codecs.getwriter(enc)(obj))
+    set_stdio_encoding()
+
+    log_level = log.INFO
+    log.basicConfig(format="%(levelname)s>> %(message)s", level=log_level)
+
+    from filterparser import FilterParser
+    engine = RuleEngine()
+    for fname in sys.argv[1:-1]:
+        with io.open(fname, encoding="UTF-8") as fd:
+            rules, index_keys = FilterParser().parse(fd)
+        engine.add_list(fname, rules, index_keys)
+    log.info("{} rules, {} triggers".format(len(engine),
+        len(engine.triggers)))
+    for name in ["block", "allow"]:
+        index = getattr(engine, name)
+        log.info("{}: {} hosts, {} tokens, {} literals, {} others".format(
+            name, len(index.hosts), len(index.tokens),
+            len(index.literals), len(index.untokenized)))
+
+    url = sys.argv[-1]
+    print(engine.match(url, {"third-party": False}))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,366 @@
+#!/usr/bin/python3
+# vim:fileencoding=utf-8:sw=4:et
+#
+# Compact in-memory store of adblock rules
+#
+# Copyright (C) 2015 Mozbugbox <mozbugbox@yahoo.com.au>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with this library; see the file COPYING.LIB.  If not, write to
+# the Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+#
+"""
+Keep loaded rules packed in a few arrays instead of one object each.
+
+A RulePack holds a batch of parsed rules: their filter lines in one
+shared text buffer with offsets, their options packed into an int, and
+the rare other options, like domain= with interned domain names. A
+RuleStore files the rules of several packs under rule ids. The regex of
+a rule is only made and compiled once a lookup reaches the rule.
+
+Usage:
+    parser = FilterParser()
+    rules, index_keys = parser.parse(fd)
+    pack = RulePack.from_rules(rules)
+    store = RuleStore()
+    rids = store.add_pack(pack)
+    store.matches(rids[0], url, {"third-party": True})
+
+Run as a command to compare the memory used by rule objects with warm
+regexes and by the packed store for some filter files.
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+import sys
+import io
+import re
+import gc
+import array
+import logging as log
+
+from sys import intern
+
+from adblockparserlite import AdblockRuleLite
+
+NATIVE=sys.getfilesystemencoding()
+
+FLAG_EXCEPTION = 1
+FLAG_EXTRA = 2 # the rule has options in RulePack.extra
+
+# Each binary option takes 2 bits of the rule flags: given and value
+OPTION_NAMES = list(AdblockRuleLite.BINARY_OPTIONS)
+OPTION_BITS = dict((name, 2 + 2*i) for i, name in enumerate(OPTION_NAMES))
+BIT_OPTIONS = dict((bit, name) for name, bit in OPTION_BITS.items())
+MATCH_CASE_BIT = 1 << OPTION_BITS["match-case"]
+# Given bits of the options a lookup must provide, all but match-case
+OPTION_GIVEN_MASK = sum(1 << bit for name, bit in OPTION_BITS.items()
+        if name != "match-case")
+
+def pack_options(options):
+    """Return (flag bits, extra options) of the options dict of a rule"""
+    bits = 0
+    extra = []
+    for name, value in options.items():
+        bit = OPTION_BITS.get(name)
+        if bit is None:
+            if name == "domain":
+                value = tuple((intern(d), v)
+                        for d, v in sorted(value.items()))
+            extra.append((intern(name), value))
+            continue
+        bits |= 1 << bit
+        if value:
+            bits |= 2 << bit
+    return bits, tuple(extra)
+
+def domain_variants(domain):
+    """Yield a domain and its parent domains down to 2 labels"""
+    parts = domain.split(".")
+    if len(parts) == 1:
+        yield domain
+        return
+    for i in range(len(parts), 1, -1):
+        yield ".".join(parts[-i:])
+
+def domain_matches(domains, domain):
+    """Test a domain against the (domain, include) pairs of a domain= option
+    """
+    for variant in domain_variants(domain):
+        for name, include in domains:
+            if name == variant:
+                return include
+    return not any(include for name, include in domains)
+
+def options_match(flags, extra, options):
+    """Test packed rule options against the options of a lookup.
+
+    Rules needing an option the lookup does not give never match.
+    """
+    given = flags & OPTION_GIVEN_MASK
+    while given:
+        low = given & -given
+        bit = low.bit_length() - 1
+        given ^= low
+        name = BIT_OPTIONS[bit]
+        if name not in options:
+            return False
+        if options[name] != bool(flags & (2 << bit)):
+            return False
+
+    for name, value in extra:
+        if name not in options:
+            return False
+        if name == "domain":
+            if not domain_matches(value, options["domain"]):
+                return False
+        elif options[name] != value:
+            return False
+    return True
+
+class RulePack:
+    """A batch of rules packed into one text buffer and arrays"""
+    def __init__(self, sources=(), flags=(), extra=None):
+        """sources are the stripped filter lines, flags their packed options
+        and extra maps a position to the options that are not packed.
+        """
+        self.text = "\n".join(sources)
+        self.offsets = array.array("I", [0])
+        pos = 0
+        for source in sources:
+            pos += len(source) + 1
+            self.offsets.append(pos)
+        self.flags = array.array("Q", flags)
+        self.extra = extra or {}
+
+    @classmethod
+    def from_rules(cls, rules):
+        """Pack parsed rule objects"""
+        sources = []
+        flags = []
+        extra = {}
+        for i, rule in enumerate(rules):
+            bits, ext = pack_options(rule.options)
+            if rule.is_exception:
+                bits |= FLAG_EXCEPTION
+            if ext:
+                bits |= FLAG_EXTRA
+                extra[i] = ext
+            sources.append(rule.raw_rule_text.strip())
+            flags.append(bits)
+        return cls(sources, flags, extra)
+
+    @classmethod
+    def concat(cls, selections):
+        """Return a new pack of the (pack, positions) selections"""
+        sources = []
+        flags = []
+        extra = {}
+        for pack, positions in selections:
+            for pos in positions:
+                if pack.flags[pos] & FLAG_EXTRA:
+                    extra[len(flags)] = pack.extra[pos]
+                sources.append(pack.source(pos))
+                flags.append(pack.flags[pos])
+        return cls(sources, flags, extra)
+
+    def __len__(self):
+        return len(self.flags)
+
+    def source(self, pos):
+        """Return the filter line of the rule at pos"""
+        return self.text[self.offsets[pos]:self.offsets[pos + 1] - 1]
+
+    def sources(self):
+        """Return the filter lines of all the rules"""
+        if not self.flags:
+            return []
+        return self.text.split("\n")
+
+class RuleStore:
+    """Rules of many packs addressed by rule id"""
+    def __init__(self):
+        self.packs = []     # pack number -> RulePack, None once unused
+        self.pack_refs = [] # pack number -> number of live rules
+        self.pack_ids = array.array("I") # rule id -> pack number
+        self.positions = array.array("I") # rule id -> position in pack
+        self.flags = array.array("Q") # rule id -> packed options
+        self.regexes = {}   # rule id -> compiled regex
+        self.free_ids = []
+
+    def __len__(self):
+        return len(self.flags) - len(self.free_ids)
+
+    def copy(self):
+        """Return a copy sharing the packs and the compiled regexes"""
+        store = RuleStore()
+        store.packs = list(self.packs)
+        store.pack_refs = list(self.pack_refs)
+        store.pack_ids = array.array("I", self.pack_ids)
+        store.positions = array.array("I", self.positions)
+        store.flags = array.array("Q", self.flags)
+        store.regexes = dict(self.regexes)
+        store.free_ids = list(self.free_ids)
+        return store
+
+    def add_pack(self, pack, positions=None):
+        """Add the rules of pack at positions, all by default.
+
+        Return the rule ids in the order of positions.
+        """
+        if positions is None:
+            positions = range(len(pack))
+        pack_no = len(self.packs)
+        self.packs.append(pack)
+        self.pack_refs.append(0)
+        rids = []
+        for pos in positions:
+            if self.free_ids:
+                rid = self.free_ids.pop()
+                self.pack_ids[rid] = pack_no
+                self.positions[rid] = pos
+                self.flags[rid] = pack.flags[pos]
+            else:
+                rid = len(self.flags)
+                self.pack_ids.append(pack_no)
+                self.positions.append(pos)
+                self.flags.append(pack.flags[pos])
+            rids.append(rid)
+        self.pack_refs[pack_no] = len(rids)
+        if not rids:
+            self.packs[pack_no] = None
+        return rids
+
+    def remove(self, rid):
+        """Free a rule id, a pack goes once none of its rules is left"""
+        pack_no = self.pack_ids[rid]
+        self.pack_refs[pack_no] -= 1
+        if not self.pack_refs[pack_no]:
+            self.packs[pack_no] = None
+        self.flags[rid] = 0
+        self.regexes.pop(rid, None)
+        self.free_ids.append(rid)
+
+    def source(self, rid):
+        """Return the filter line of a rule"""
+        return self.packs[self.pack_ids[rid]].source(self.positions[rid])
+
+    def extra(self, rid):
+        """Return the options of a rule that are not packed"""
+        if not self.flags[rid] & FLAG_EXTRA:
+            return ()
+        return self.packs[self.pack_ids[rid]].extra[self.positions[rid]]
+
+    def is_exception(self, rid):
+        return bool(self.flags[rid] & FLAG_EXCEPTION)
+
+    def options_match(self, rid, options):
+        """Test the options of a rule, skipping rules needing missing options
+        """
+        flags = self.flags[rid]
+        if not flags & (OPTION_GIVEN_MASK | FLAG_EXTRA):
+            return True
+        return options_match(flags, self.extra(rid), options)
+
+    def pattern(self, rid):
+        """Return the url pattern of a rule, without @@ and options"""
+        text = self.source(rid)
+        if self.flags[rid] & FLAG_EXCEPTION:
+            text = text[2:]
+        return text.partition("$")[0]
+
+    def url_matches(self, rid, url):
+        """Test the url pattern of a rule, compiling its regex on first use"""
+        regex_re = self.regexes.get(rid)
+        if regex_re is None:
+            # Adblock rules are case-insensitive unless marked match-case
+            flags = 0 if self.flags[rid] & MATCH_CASE_BIT else re.IGNORECASE
+            regex = AdblockRuleLite.rule_to_regex(self.pattern(rid))
+            regex_re = re.compile(regex, flags)
+            self.regexes[rid] = regex_re
+        return bool(regex_re.search(url))
+
+    def matches(self, rid, url, options):
+        """Test a rule against url, skipping rules needing missing options"""
+        return self.options_match(rid, options) and self.url_matches(rid, url)
+
+    def rule(self, rid):
+        """Return a rule object of a rule id, e.g. to show the rule"""
+        return AdblockRuleLite(self.source(rid))
+
+def resident_size():
+    """Return the resident set size of the process in bytes, or 0"""
+    try:
+        with io.open("/proc/self/statm") as fd:
+            pages = int(fd.read().split()[1])
+    except (IOError, OSError):
+        return 0
+    import resource
+    return pages * resource.getpagesize()
+
+def measure(mode, fnames):
+    """Load filter files as rule objects or packed, return memory used.
+
+    Return (rule count, bytes traced by tracemalloc, resident size
+    growth). Meant to run in a fresh process.
+    """
+    import tracemalloc
+    from filterparser import FilterParser
+    lines = []
+    for fname in fnames:
+        with io.open(fname, encoding="UTF-8") as fd:
+            lines.extend(fd.read().splitlines())
+
+    gc.collect()
+    rss_start = resident_size()
+    tracemalloc.start()
+    rules, index_keys = FilterParser().parse(lines)
+    del index_keys
+    if mode == "objects":
+        for rule in rules:
+            rule._url_matches("") # compiled regexes, as after long use
+        result = rules
+    else:
+        result = RuleStore()
+        result.add_pack(RulePack.from_rules(rules))
+    del rules
+    gc.collect()
+    traced = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return len(result), traced, resident_size() - rss_start
+
+def main():
+    def set_stdio_encoding(enc=NATIVE):
+        import codecs; stdio = ["stdin", "stdout", "stderr"]
+        for x in stdio:
+            obj = getattr(sys, x)
+            if not obj.encoding: setattr(sys,  x, codecs.getwriter(enc)(obj))
+    set_stdio_encoding()
+
+    log_level = log.INFO
+    log.basicConfig(format="%(levelname)s>> %(message)s", level=log_level)
+
+    import multiprocessing
+    mb = 1024.0 * 1024
+    fnames = sys.argv[1:]
+    for mode in ["objects", "packed"]:
+        # a fresh process each, freed memory is not given back to the OS
+        pool = multiprocessing.Pool(1)
+        count, traced, rss = pool.apply(measure, (mode, fnames))
+        pool.close()
+        pool.join()
+        print("{:8s} {} rules: {:.2f} MB allocated, {:.2f} MB resident"
+                .format(mode, count, traced / mb, rss / mb))
+
+if __name__ == '__main__':
+    main()
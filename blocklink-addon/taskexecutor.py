@@ -0,0 +1,242 @@
+#!/usr/bin/python3
+# vim:fileencoding=utf-8:sw=4:et
+#
+# Futures resolved on the main loop
+#
+# Copyright (C) 2015 Mozbugbox <mozbugbox@yahoo.com.au>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with this library; see the file COPYING.LIB.  If not, write to
+# the Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+#
+"""
+A Task is a future that is only ever resolved, and runs its callbacks,
+on the main loop. Work runs on a thread pool or comes from a
+concurrent.futures future, e.g. a download, and its outcome is handed
+to the main loop through deliver(func, *args), e.g. GObject.idle_add.
+
+Tasks chain with after(): the function runs on the main loop once all
+the tasks it depends on are done, and may return another Task to wait
+for. Nothing sleeps or polls. shutdown() cancels whatever is pending.
+
+Usage:
+    executor = TaskExecutor(GObject.idle_add)
+    listed = executor.task("filter list")
+    parsed = executor.after([listed], "parse", parse_func, fname)
+    listed.set_result(filter_list) # parse_func(fname, filter_list) runs
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+import sys
+import logging as log
+from concurrent import futures
+
+NATIVE=sys.getfilesystemencoding()
+
+PENDING = "pending"
+DONE = "done"
+CANCELLED = "cancelled"
+
+class TaskError(Exception):
+    pass
+
+class TaskCancelled(TaskError):
+    pass
+
+class Task:
+    """Outcome of some work, resolved on the main loop"""
+    def __init__(self, name=""):
+        self.name = name
+        self._state = PENDING
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._cancel_func = None # stops the work behind the task
+
+    def __repr__(self):
+        return "<Task {} {}>".format(self.name, self._state)
+
+    def done(self):
+        return self._state != PENDING
+
+    def cancelled(self):
+        return self._state == CANCELLED
+
+    def result(self):
+        if self._state == PENDING:
+            raise TaskError("{} is pending".format(self.name))
+        if self._state == CANCELLED:
+            raise TaskCancelled(self.name)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        """Return the exception of a failed task, None otherwise"""
+        if self._state == CANCELLED:
+            return TaskCancelled(self.name)
+        return self._exception
+
+    def add_done_callback(self, func):
+        """Call func(task) once done, right away if it is done already"""
+        if self.done():
+            func(self)
+        else:
+            self._callbacks.append(func)
+
+    def _finish(self, state, result=None, exception=None):
+        if self.done():
+            return False
+        self._state = state
+        self._result = result
+        self._exception = exception
+        self._cancel_func = None
+        callbacks = self._callbacks
+        self._callbacks = []
+        for func in callbacks:
+            try:
+                func(self)
+            except Exception:
+                log.exception("callback of {} failed".format(self.name))
+        return True
+
+    def set_result(self, result):
+        return self._finish(DONE, result)
+
+    def set_exception(self, exception):
+        return self._finish(DONE, exception=exception)
+
+    def cancel(self):
+        """Cancel a pending task, return False if it was done already"""
+        if self.done():
+            return False
+        cancel_func = self._cancel_func
+        if cancel_func is not None:
+            cancel_func()
+        return self._finish(CANCELLED)
+
+class TaskExecutor:
+    """Make and chain Tasks, run work on a thread pool"""
+    def __init__(self, deliver, workers=2):
+        """deliver(func, *args) is expected to call func on the main loop
+        """
+        self.deliver = deliver
+        self.workers = workers
+        self._executor = None
+        self._tasks = set() # pending tasks
+
+    def _track(self, task):
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def task(self, name):
+        """Return a new pending task the caller resolves"""
+        return self._track(Task(name))
+
+    def wrap(self, future, name):
+        """Return a task following a concurrent.futures future"""
+        task = self._track(Task(name))
+        task._cancel_func = future.cancel
+        def _done(fut):
+            # on the worker thread
+            self.deliver(self._resolve, task, fut)
+        future.add_done_callback(_done)
+        return task
+
+    def _resolve(self, task, future):
+        if task.done():
+            return False
+        if future.cancelled():
+            task.cancel()
+        elif future.exception() is not None:
+            task.set_exception(future.exception())
+        else:
+            task.set_result(future.result())
+        return False
+
+    def run_in_thread(self, name, func, *args):
+        """Run func(*args) on the thread pool, return its task"""
+        if self._executor is None:
+            self._executor = futures.ThreadPoolExecutor(
+                    max_workers=self.workers)
+        return self.wrap(self._executor.submit(func, *args), name)
+
+    def after(self, deps, name, func, *args):
+        """Return a task of func(*args, *results of deps) called on the
+        main loop once all deps are done.
+
+        The task fails or is cancelled with the first dep that does. If
+        func returns a Task, the task is done when that one is.
+        """
+        task = self._track(Task(name))
+        deps = list(deps)
+
+        def _dep_done(dep):
+            if task.done():
+                return
+            if dep is not None and dep.exception() is not None:
+                if dep.cancelled():
+                    task.cancel()
+                else:
+                    task.set_exception(dep.exception())
+                return
+            if not all(x.done() for x in deps):
+                return
+            try:
+                ret = func(*(args + tuple(x.result() for x in deps)))
+            except TaskError as e:
+                task.set_exception(e)
+                return
+            except Exception as e:
+                log.exception("{} failed".format(name))
+                task.set_exception(e)
+                return
+            if isinstance(ret, Task):
+                self._follow(ret, task)
+            else:
+                task.set_result(ret)
+
+        if not deps:
+            _dep_done(None)
+        for dep in deps:
+            dep.add_done_callback(_dep_done)
+        return task
+
+    def _follow(self, inner, outer):
+        """Resolve outer task like inner, cancelling outer cancels inner"""
+        outer._cancel_func = inner.cancel
+        def _inner_done(t):
+            if t.cancelled():
+                outer.cancel()
+            elif t.exception() is not None:
+                outer.set_exception(t.exception())
+            else:
+                outer.set_result(t.result())
+        inner.add_done_callback(_inner_done)
+
+    def pending(self):
+        return list(self._tasks)
+
+    def shutdown(self):
+        """Cancel the pending tasks and stop the thread pool.
+
+        The executor can be used again afterwards.
+        """
+        for task in list(self._tasks):
+            task.cancel()
+        self._tasks.clear()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
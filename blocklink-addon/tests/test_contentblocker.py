@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+# vim:fileencoding=utf-8:sw=4:et
+#
+# Tests of the adblock to WebKit content blocker translation
+#
+# Copyright (C) 2015 Mozbugbox <mozbugbox@yahoo.com.au>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with this library; see the file COPYING.LIB.  If not, write to
+# the Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+#
+"""
+Translate the fixture filter lists offline and check the content blocker
+JSON: the action types, the exception rules after all the blocking
+rules, the `||` host anchor and the triggers of the options.
+
+Usage:
+    python3 -m pytest tests/test_contentblocker.py
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+import sys
+import os
+import re
+import glob
+import json
+import unittest
+
+ADDON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ADDON_DIR)
+
+import contentblocker
+from contentblocker import (HOST_ANCHOR, SEPARATOR, read_sources, translate,
+        translate_rule, to_json)
+
+FIXTURES = sorted(glob.glob(os.path.join(ADDON_DIR, "fixtures", "*.txt")))
+ACTIONS = frozenset(["block", "ignore-previous-rules"])
+
+class FixtureTranslationTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.sources = read_sources(FIXTURES)
+        cls.rules, cls.counts = translate(cls.sources)
+        cls.content = json.loads(to_json(cls.rules))
+
+    def test_counts(self):
+        self.assertTrue(FIXTURES)
+        counts = self.counts
+        self.assertEqual(counts["translated"] + counts["unsupported"],
+                len(self.sources))
+        self.assertGreater(self.counts["translated"], 0)
+        self.assertEqual(len(self.content), len(self.rules))
+
+    def test_rule_shape(self):
+        for rule in self.content:
+            self.assertEqual(sorted(rule), ["action", "trigger"])
+            self.assertIn(rule["action"]["type"], ACTIONS)
+            url_filter = rule["trigger"]["url-filter"]
+            url_filter.encode("ascii")
+            re.compile(url_filter)
+
+    def test_exceptions_last(self):
+        types = [x["action"]["type"] for x in self.content]
+        self.assertIn("ignore-previous-rules", types)
+        first_exception = types.index("ignore-previous-rules")
+        self.assertNotIn("block", types[first_exception:])
+        exceptions = sum(1 for x in self.sources if x.startswith("@@"))
+        self.assertGreater(exceptions, 0)
+
+    def test_host_anchor(self):
+        hosts = [x for x in self.sources if x.startswith("||")
+                and x.endswith("^") and "$" not in x]
+        self.assertTrue(hosts)
+        host = hosts[0][2:-1]
+        filters = [x["trigger"]["url-filter"] for x in self.content
+                if x["trigger"]["url-filter"].startswith(HOST_ANCHOR)]
+        escaped = HOST_ANCHOR + re.escape(host).replace("\\-", "-")
+        self.assertIn(escaped + SEPARATOR, filters)
+        self.assertIn(escaped + "$", filters)
+
+class TranslateRuleTest(unittest.TestCase):
+    def filters(self, source):
+        return [x["trigger"]["url-filter"] for x in translate_rule(source)]
+
+    def test_host_rule(self):
+        filters = self.filters("||ads.example.com^")
+        self.assertEqual(filters, [
+            HOST_ANCHOR + r"ads\.example\.com" + SEPARATOR,
+            HOST_ANCHOR + r"ads\.example\.com$"])
+        matches = lambda url: any(re.search(x, url) for x in filters)
+        self.assertTrue(matches("https://ads.example.com/banner.gif"))
+        self.assertTrue(matches("http://cdn.ads.example.com"))
+        self.assertFalse(matches("https://badads.example.com/"))
+        self.assertFalse(matches("https://ads.example.community/"))
+
+    def test_exception_order(self):
+        rules, counts = translate(["@@||example.com/ok^", "||example.com^"])
+        self.assertEqual([x["action"]["type"] for x in rules],
+                ["block", "block", "ignore-previous-rules",
+                    "ignore-previous-rules"])
+
+    def test_options(self):
+        rule = translate_rule("||cdn.example.com^$script,domain=news.com")[0]
+        self.assertEqual(rule["trigger"]["resource-type"], ["script"])
+        self.assertEqual(rule["trigger"]["if-domain"], ["*news.com"])
+        rule = translate_rule("/ads/*$third-party,domain=~a.com|~b.com")[0]
+        self.assertEqual(rule["trigger"]["load-type"], ["third-party"])
+        self.assertEqual(rule["trigger"]["unless-domain"],
+                ["*a.com", "*b.com"])
+        self.assertEqual(translate_rule("/ads/*$~image")[0]["trigger"][
+            "resource-type"], sorted(contentblocker.ALL_RESOURCE_TYPES -
+                set(["image"])))
+
+    def test_idna_domains(self):
+        rule = translate_rule("/ads/*$domain=b\u00fccher.de|example.com")[0]
+        self.assertEqual(rule["trigger"]["if-domain"],
+                ["*example.com", "*xn--bcher-kva.de"])
+
+    def test_unsupported(self):
+        for source in ["/ads/$domain=a.com|~b.com", "/ad(s|v)/",
+                "||example.com^$csp=script-src", "example.com##.ad",
+                "/ads/$domain=a..com"]:
+            self.assertIsNone(translate_rule(source), source)
+
+if __name__ == '__main__':
+    unittest.main()
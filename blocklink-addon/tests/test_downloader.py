@@ -0,0 +1,172 @@
+#!/usr/bin/python3
+# vim:fileencoding=utf-8:sw=4:et
+#
+# Tests of the filter list downloader against a local HTTP server
+#
+# Copyright (C) 2015 Mozbugbox <mozbugbox@yahoo.com.au>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with this library; see the file COPYING.LIB.  If not, write to
+# the Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+#
+"""
+Run the Downloader against an http.server on localhost: a first fetch,
+a conditional fetch answered with 304, a truncated body, a redirect
+without a Location and the reuse of a kept-alive connection.
+
+Usage:
+    python3 -m pytest tests/test_downloader.py
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+import sys
+import os
+import io
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+
+try:
+    from http import server as httpserver
+except ImportError:
+    import BaseHTTPServer as httpserver
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from downloader import (Downloader, DownloadError, FETCH_DOWNLOADED,
+        FETCH_NOT_MODIFIED, META_SUFFIX)
+
+LIST_BODY = "! Title: test\n||ads.example.com^\n/banner/*\n".encode("UTF-8")
+LIST_ETAG = '"list-1"'
+LIST_MODIFIED = "Thu, 01 Oct 2015 12:00:00 GMT"
+
+class ListHandler(httpserver.BaseHTTPRequestHandler):
+    """Serve /list.txt with validators and a /truncated.txt that stops
+    short of its Content-Length"""
+    protocol_version = "HTTP/1.1" # keep-alive
+
+    def setup(self):
+        httpserver.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers.items())))
+        if self.path == "/list.txt":
+            if (self.headers.get("If-None-Match") == LIST_ETAG or
+                    self.headers.get("If-Modified-Since") == LIST_MODIFIED):
+                self.send_response(304)
+                self.send_header("ETag", LIST_ETAG)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(LIST_BODY)))
+            self.send_header("ETag", LIST_ETAG)
+            self.send_header("Last-Modified", LIST_MODIFIED)
+            self.end_headers()
+            self.wfile.write(LIST_BODY)
+        elif self.path == "/truncated.txt":
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(LIST_BODY) + 100))
+            self.end_headers()
+            self.wfile.write(LIST_BODY)
+            self.close_connection = True
+        elif self.path == "/moved.txt":
+            self.send_response(302)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        else:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+class DownloaderTest(unittest.TestCase):
+    def setUp(self):
+        self.server = httpserver.HTTPServer(("127.0.0.1", 0), ListHandler)
+        self.server.connections = 0
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.base_url = "http://127.0.0.1:{}".format(
+                self.server.server_address[1])
+        self.tmp_dir = tempfile.mkdtemp(prefix="blocklink-test-")
+        self.downloader = Downloader(workers=1)
+
+    def tearDown(self):
+        self.downloader.shutdown()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def fetch(self, path, fname="list.txt"):
+        output_name = os.path.join(self.tmp_dir, fname)
+        return output_name, self.downloader.fetch(self.base_url + path,
+                output_name)
+
+    def test_first_fetch(self):
+        output_name, (status, content_hash) = self.fetch("/list.txt")
+        self.assertEqual(status, FETCH_DOWNLOADED)
+        self.assertEqual(content_hash, hashlib.sha1(LIST_BODY).hexdigest())
+        with io.open(output_name, "rb") as fd:
+            self.assertEqual(fd.read(), LIST_BODY)
+        self.assertTrue(os.path.exists(output_name + META_SUFFIX))
+        path, headers = self.server.requests[0]
+        self.assertNotIn("If-None-Match", headers)
+        self.assertNotIn("If-Modified-Since", headers)
+
+    def test_not_modified(self):
+        output_name, result = self.fetch("/list.txt")
+        mtime = os.path.getmtime(output_name)
+        output_name, (status, content_hash) = self.fetch("/list.txt")
+        self.assertEqual(status, FETCH_NOT_MODIFIED)
+        self.assertIsNone(content_hash)
+        path, headers = self.server.requests[1]
+        self.assertEqual(headers.get("If-None-Match"), LIST_ETAG)
+        self.assertEqual(headers.get("If-Modified-Since"), LIST_MODIFIED)
+        self.assertEqual(os.path.getmtime(output_name), mtime)
+
+    def test_truncated_body(self):
+        output_name = os.path.join(self.tmp_dir, "list.txt")
+        with io.open(output_name, "wb") as fdw:
+            fdw.write(b"old list\n")
+        with self.assertRaises(DownloadError):
+            self.fetch("/truncated.txt")
+        # the old file is kept and no temp file is left behind
+        self.assertEqual(os.listdir(self.tmp_dir), ["list.txt"])
+        with io.open(output_name, "rb") as fd:
+            self.assertEqual(fd.read(), b"old list\n")
+
+    def test_redirect_without_location(self):
+        with self.assertRaises(DownloadError):
+            self.fetch("/moved.txt")
+        # the connection went back to the pool open and is reused
+        output_name, (status, content_hash) = self.fetch("/list.txt")
+        self.assertEqual(status, FETCH_DOWNLOADED)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_connection_reuse(self):
+        self.fetch("/list.txt", "a.txt")
+        self.fetch("/list.txt", "b.txt")
+        self.fetch("/list.txt", "b.txt")
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(self.server.connections, 1)
+
+if __name__ == '__main__':
+    unittest.main()
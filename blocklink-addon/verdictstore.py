@@ -0,0 +1,114 @@
+#!/usr/bin/python3
+# vim:fileencoding=utf-8:sw=4:et
+#
+# Append-only persistent store for cached block verdicts
+#
+# Copyright (C) 2015 Mozbugbox <mozbugbox@yahoo.com.au>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with this library; see the file COPYING.LIB.  If not, write to
+# the Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+#
+"""
+Journal of cache entries: every insert appends one JSON line, so the
+cost of a write does not depend on the size of the cache. Replaying the
+journal in order rebuilds the cache. Once the journal holds a lot more
+lines than the cache can keep, it is compacted to the live entries.
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+import sys
+import os
+import io
+import json
+import logging as log
+
+NATIVE=sys.getfilesystemencoding()
+
+class VerdictJournal:
+    """Append-only journal of (key, value) cache entries"""
+    def __init__(self, path, capacity):
+        self.path = path
+        self.capacity = capacity
+        self.line_count = 0
+        self._fdw = None
+
+    def replay(self):
+        """Yield the (key, value) entries of the journal in insert order"""
+        self.line_count = 0
+        if not os.path.exists(self.path):
+            return
+        with io.open(self.path, encoding="UTF-8") as fd:
+            for line in fd:
+                self.line_count += 1
+                try:
+                    key, value = json.loads(line)
+                except ValueError:
+                    continue # torn write of a crashed session
+                yield key, value
+
+    def append(self, key, value):
+        """Write one entry to the journal"""
+        try:
+            if self._fdw is None:
+                self._fdw = io.open(self.path, "a", encoding="UTF-8")
+            self._fdw.write(json.dumps([key, value], ensure_ascii=False,
+                separators=(",", ":")) + "\n")
+            self._fdw.flush()
+            self.line_count += 1
+        except IOError as e:
+            log.warning("Failed to write {}: {}".format(self.path, e))
+
+    def needs_compact(self):
+        """Test if the journal has grown well past the cache capacity"""
+        return self.line_count > max(2 * self.capacity, 1024)
+
+    def compact(self, items):
+        """Replace the journal with the given live (key, value) entries"""
+        self.close()
+        tmp_path = self.path + ".tmp"
+        count = 0
+        try:
+            with io.open(tmp_path, "w", encoding="UTF-8") as fdw:
+                for key, value in items:
+                    fdw.write(json.dumps([key, value], ensure_ascii=False,
+                        separators=(",", ":")) + "\n")
+                    count += 1
+            os.rename(tmp_path, self.path)
+            self.line_count = count
+        except (IOError, OSError) as e:
+            log.warning("Failed to compact {}: {}".format(self.path, e))
+
+    def close(self):
+        if self._fdw is not None:
+            self._fdw.close()
+            self._fdw = None
+
+def main():
+    def set_stdio_encoding(enc=NATIVE):
+        import codecs; stdio = ["stdin", "stdout", "stderr"]
+        for x in stdio:
+            obj = getattr(sys, x)
+            if not obj.encoding: setattr(sys,  x, codecs.getwriter(enc)(obj))
+    set_stdio_encoding()
+
+    log_level = log.INFO
+    log.basicConfig(format="%(levelname)s>> %(message)s", level=log_level)
+
+    journal = VerdictJournal(sys.argv[1], 0)
+    entries = dict(journal.replay())
+    print("{} lines, {} entries".format(journal.line_count, len(entries)))
+
+if __name__ == '__main__':
+    main()